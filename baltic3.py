@@ -1,7 +1,11 @@
+import io
 import re
 import copy
 import math
+import functools
+import heapq
 import datetime as dt
+import numpy as np
 
 # Should I have mutual dependencies between baltic3 and baltic3_utils?
 import baltic3 as btu
@@ -12,7 +16,238 @@ def unique(o, idfun=repr):
     return [seen.setdefault(idfun(e),e) for e in o if idfun(e) not in seen]
 
 
-class clade: ## clade class
+def decode_comment(comment,traits):
+    """ Decode the contents of a [&...] comment (without the enclosing brackets) into a trait dictionary. """
+    numerics=re.findall('[A-Za-z\_\.0-9]+=[0-9\-Ee\.]+',comment) ## find all entries that have values as floats
+    strings=re.findall('[A-Za-z\_\.0-9]+=["|\']*[A-Za-z\_0-9\.\+]+["|\']*',comment) ## strings
+    treelist=re.findall('[A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\.]+}',comment) ## complete history logged robust counting (MCMC trees)
+    sets=re.findall('[A-Za-z\_\.0-9\%]+={[A-Za-z\.\-0-9eE,\"\_]+}',comment) ## sets and ranges
+    figtree=re.findall('\![A-Za-z]+=[A-Za-z0-9#]+',comment)
+
+    for vals in strings:
+        tr,val=vals.split('=')
+        if '+' in val:
+            val=val.split('+')[0] ## DO NOT ALLOW EQUIPROBABLE DOUBLE ANNOTATIONS (which are in format "A+B") - just get the first one
+        traits[tr]=val.strip('"')
+
+    for vals in numerics: ## assign all parsed annotations to traits of current branch
+        tr,val=vals.split('=') ## split each value by =, left side is name, right side is value
+        traits[tr]=float(val)
+
+    for val in treelist:
+        tr,val=val.split('=')
+        microcerberus=re.findall('{([0-9]+,[0-9\.\-e]+,[A-Z]+,[A-Z]+)}',val)
+        traits[tr]=[]
+        for val in microcerberus:
+            codon,timing,start,end=val.split(',')
+            traits[tr].append((int(codon),float(timing),start,end))
+
+    for vals in sets:
+        tr,val=vals.split('=')
+        if 'set' in tr:
+            traits[tr]=[]
+            for v in val[1:-1].split(','):
+                if 'set.prob' in tr:
+                    traits[tr].append(float(v))
+                else:
+                    traits[tr].append(v.strip('"'))
+        elif 'range' in tr or 'HPD' in tr:
+            traits[tr]=list(map(float,val[1:-1].split(',')))
+        else:
+            print('some other trait: %s'%(vals))
+
+    if len(figtree)>0:
+        print('FigTree comment found, ignoring')
+    return traits
+
+
+_comment_entry=re.compile(r'([^=,{}"]+)=("[^"]*"|\{(?:[^{}]|\{[^{}]*\})*\}|[^,]*)')
+
+def split_comment(comment):
+    """ Split the contents of a [&...] comment into (trait name, raw 'name=value' entry) pairs without decoding any values. """
+    return [(cerberus.group(1),cerberus.group()) for cerberus in _comment_entry.finditer(comment)]
+
+def _rebuild_lazy_traits(decoded,pending):
+    """ Unpickling/copying helper for lazy_traits. """
+    traits=lazy_traits('')
+    dict.update(traits,decoded)
+    traits._entries=pending
+    return traits
+
+class lazy_traits(dict): ## trait dictionary that decodes annotations on demand
+    """ Dictionary of traits that keeps the raw entries of a [&...] comment and only decodes a trait the first time it is accessed.
+    Operations that need every trait (iteration, keys(), items(), len(), etc.) decode whatever is left. """
+    def __init__(self,comment):
+        dict.__init__(self)
+        self.comment=comment ## raw comment, not even split into entries until a trait is first needed
+        self._entries=None ## trait name: raw entry, for traits not decoded yet
+
+    @property
+    def _pending(self):
+        if self._entries is None:
+            self._entries=dict(split_comment(self.comment))
+        return self._entries
+
+    def decode(self,keys=None):
+        """ Decode the given trait names (default: everything still pending). """
+        if keys is None:
+            keys=list(self._pending.keys())
+        for key in keys:
+            entry=self._pending.pop(key,None)
+            if entry is not None:
+                decode_comment(entry,self)
+        return self
+
+    def __missing__(self,key):
+        if key in self._pending:
+            self.decode([key])
+            if dict.__contains__(self,key):
+                return dict.__getitem__(self,key)
+        raise KeyError(key)
+
+    def __contains__(self,key):
+        if key in self._pending:
+            self.decode([key])
+        return dict.__contains__(self,key)
+
+    def get(self,key,default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self,key,value):
+        self._pending.pop(key,None)
+        dict.__setitem__(self,key,value)
+
+    def __delitem__(self,key):
+        if key in self._pending and not dict.__contains__(self,key):
+            self._pending.pop(key)
+        else:
+            self._pending.pop(key,None)
+            dict.__delitem__(self,key)
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key]=default
+        return self[key]
+
+    def pop(self,key,*default):
+        self.decode([key])
+        return dict.pop(self,key,*default)
+
+    def popitem(self):
+        return dict.popitem(self.decode())
+
+    def update(self,*args,**kwargs):
+        for key,value in dict(*args,**kwargs).items():
+            self[key]=value
+
+    def keys(self):
+        return dict.keys(self.decode())
+
+    def values(self):
+        return dict.values(self.decode())
+
+    def items(self):
+        return dict.items(self.decode())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __iter__(self):
+        return dict.__iter__(self.decode())
+
+    def __len__(self):
+        return dict.__len__(self.decode())
+
+    def __eq__(self,other):
+        return dict.__eq__(self.decode(),other)
+
+    def __ne__(self,other):
+        return not self==other
+
+    def __repr__(self):
+        return dict.__repr__(self.decode())
+
+    def __reduce__(self):
+        return (_rebuild_lazy_traits,(dict(dict.items(self)),dict(self._pending)))
+
+def assign_comment(branch,comment,lazy=False,trait_keys=None):
+    """ Attach the contents of a [&...] comment (without the enclosing brackets) to a branch's traits.
+    lazy: keep the raw comment and decode each trait on first access (see lazy_traits).
+    trait_keys: names of traits to decode straight away. Without lazy, any other traits are discarded. """
+    if lazy==True:
+        traits=lazy_traits(comment)
+        if trait_keys is not None:
+            traits.decode(trait_keys)
+        if dict.__len__(branch.traits)==0 and not isinstance(branch.traits,lazy_traits):
+            branch.traits=traits
+        else: ## branch already carries annotations, e.g. a node label
+            branch.traits.update(traits)
+    elif trait_keys is not None:
+        for key,entry in split_comment(comment):
+            if key in trait_keys:
+                decode_comment(entry,branch.traits)
+    else:
+        decode_comment(comment,branch.traits)
+
+@functools.lru_cache(maxsize=2**16)
+def _format_trait(tr,value):
+    """ Format a single trait for a [&...] comment, value is a key from _trait_key() so that e.g. 1.0 and True are cached apart. """
+    kind,value=value[0],value[1]
+    if kind is str:
+        return '%s="%s"'%(tr,value)
+    elif kind is float:
+        return '%s=%s'%(tr,value)
+    elif kind is list:
+        rangeComment=[]
+        for entry in value:
+            vkind,val=entry[0],entry[1]
+            if vkind is str:
+                rangeComment.append('"%s"'%(val))
+            elif vkind is float:
+                rangeComment.append('%s'%(val))
+        return '%s={%s}'%(tr,','.join(rangeComment))
+    return None
+
+def _trait_key(value):
+    """ Hashable (type, value) key for _format_trait(), other types are not written out.
+    Floats also carry their sign, since -0.0==0.0 would otherwise share a cache entry. """
+    if isinstance(value,str):
+        return (str,value)
+    elif isinstance(value,float):
+        return (float,float(value),math.copysign(1.0,value))
+    elif isinstance(value,list):
+        return (list,tuple(_trait_key(val) for val in value))
+    return (None,None)
+
+def format_comment(branch_traits,traits):
+    """ Format the traits named in traits (in that order) that are present in branch_traits as a [&...] comment, empty string if there are none. """
+    comment=[]
+    for tr in traits:
+        if tr in branch_traits:
+            formatted=_format_trait(tr,_trait_key(branch_traits[tr]))
+            if formatted is not None:
+                comment.append(formatted)
+    if len(comment)>0:
+        return '[&'+','.join(comment)+']'
+    return ''
+
+def _get_leaves(self):
+    """ Sorted names of all tips descending from a node, read off the tip order of its tree. """
+    return sorted(set([k.numName for k in self._tips[self.firstTip:self.lastTip]]))
+
+## Common bases of the regular and compact branch classes, for isinstance() checks that cover both.
+## They hold no attributes of their own, so the compact classes below keep theirs in __slots__ alone.
+class clade_base:
+    __slots__=()
+
+class node_base:
+    __slots__=()
+    leaves=property(_get_leaves) ## sorted list of names of all tips that eventually descend from it
+
+class leaf_base:
+    __slots__=()
+
+class clade(clade_base): ## clade class
     def __init__(self,givenName):
         self.branchType='leaf' ## clade class poses as a leaf
         self.subtree=None ## subtree will contain all the branches that were collapsed
@@ -25,13 +260,14 @@ class clade: ## clade class
         self.name=givenName ## the pretend tip name for the clade
         self.numName=givenName
         self.leaves=[]
+        self.firstTip=None ## position of the clade in its tree's tip order
         self.x=None
         self.y=None
         self.lastHeight=None ## refers to the height of the highest tip in the collapsed clade
         self.lastAbsoluteTime=None ## refers to the absolute time of the highest tip in the collapsed clade
         self.width=1
 
-class node: ## node class
+class node(node_base): ## node class
     def __init__(self):
         self.branchType='node'
         self.length=0.0 ## branch length, recovered from string
@@ -45,10 +281,12 @@ class node: ## node class
         self.numChildren=0 ## number of tips that eventually descend from this node
         self.x=None ## X and Y coordinates of this node, once drawTree() is called
         self.y=None
-        ## contains references to all tips of this node
-        self.leaves=[] ## is a sorted list of all tips that eventually descend from it
+        ## descendant tips of this node are tips firstTip to lastTip (not included) of its tree's tip order (tree.tipOrder)
+        self.firstTip=0
+        self.lastTip=0
+        self._tips=() ## the tip order itself, shared by all nodes of a tree
 
-class leaf: ## leaf class
+class leaf(leaf_base): ## leaf class
     def __init__(self):
         self.branchType='leaf'
         self.name=None ## name of tip after translation, since BEAST trees will generally have numbers for taxa but will provide a map at the beginning of the file
@@ -61,10 +299,112 @@ class leaf: ## leaf class
         self.traits={} ## trait dictionary
         self.x=None ## position of tip on x axis if the tip were to be plotted
         self.y=None ## position of tip on y axis if the tip were to be plotted
+        self.firstTip=None ## position of tip in its tree's tip order
+
+class _attach_on_write_dict(dict):
+    """ Empty dictionary handed out by compact branches that have no traits yet, becomes the branch's traits on first write. """
+    __slots__=('_owner',)
+    def __init__(self,owner):
+        dict.__init__(self)
+        self._owner=owner
+
+    def _attach(self):
+        if self._owner is not None:
+            self._owner._traits=self
+            self._owner=None
+
+    def __setitem__(self,key,value):
+        self._attach()
+        dict.__setitem__(self,key,value)
+
+    def __ior__(self,other):
+        self._attach()
+        return dict.__ior__(self,other)
+
+    def setdefault(self,key,default=None):
+        self._attach()
+        return dict.setdefault(self,key,default)
+
+    def update(self,*args,**kwargs):
+        self._attach()
+        dict.update(self,*args,**kwargs)
+
+    def __reduce__(self): ## copies and pickles are plain dictionaries
+        return (dict,(dict(self),))
+
+def _get_traits(self):
+    return self._traits if self._traits is not None else _attach_on_write_dict(self)
+
+def _set_traits(self,traits):
+    if isinstance(traits,_attach_on_write_dict):
+        traits._owner=None ## an empty handed out by another branch now belongs to this one
+    self._traits=traits
+
+## Compact versions of the branch classes used by tree(compact=True).
+## Their attributes live in __slots__ (instances have no __dict__) and empty traits are only allocated once something is written to them.
+class compact_node(node_base):
+    __slots__=('length','height','absoluteTime','parent','children','_traits','index','childHeight','numChildren','x','y','firstTip','lastTip','_tips')
+    branchType='node'
+    traits=property(_get_traits,_set_traits)
+    def __init__(self):
+        self.length=0.0
+        self.height=None
+        self.absoluteTime=None
+        self.parent=None
+        self.children=[]
+        self._traits=None
+        self.index=None
+        self.childHeight=None
+        self.numChildren=0
+        self.x=None
+        self.y=None
+        self.firstTip=0
+        self.lastTip=0
+        self._tips=()
+
+class compact_leaf(leaf_base):
+    __slots__=('name','numName','index','length','absoluteTime','height','parent','_traits','x','y','firstTip')
+    branchType='leaf'
+    traits=property(_get_traits,_set_traits)
+    def __init__(self):
+        self.name=None
+        self.numName=None
+        self.index=None
+        self.length=None
+        self.absoluteTime=None
+        self.height=None
+        self.parent=None
+        self._traits=None
+        self.x=None
+        self.y=None
+        self.firstTip=None
+
+class compact_clade(clade_base):
+    __slots__=('subtree','length','height','absoluteTime','parent','_traits','index','name','numName','leaves','firstTip','x','y','lastHeight','lastAbsoluteTime','width')
+    branchType='leaf'
+    traits=property(_get_traits,_set_traits)
+    def __init__(self,givenName):
+        self.subtree=None
+        self.length=0.0
+        self.height=None
+        self.absoluteTime=None
+        self.parent=None
+        self._traits=None
+        self.index=None
+        self.name=givenName
+        self.numName=givenName
+        self.leaves=[]
+        self.firstTip=None ## position of the clade in its tree's tip order
+        self.x=None
+        self.y=None
+        self.lastHeight=None
+        self.lastAbsoluteTime=None
+        self.width=1
 
 class tree: ## tree class
-    def __init__(self):
-        self.cur_node=node() ## current node is a new instance of a node class
+    def __init__(self,compact=False):
+        self.compact=compact ## compact trees are built from slotted branch classes that use less memory
+        self.cur_node=compact_node() if compact else node() ## current node is a new instance of a node class
         self.cur_node.index='Root' ## first object in the tree is the root to which the rest gets attached
         self.cur_node.length=0.0 ## startind node branch length is 0
         self.cur_node.height=0.0 ## starting node height is 0
@@ -72,13 +412,203 @@ class tree: ## tree class
         self.Objects=[] ## tree objects have a flat list of all branches in them
         self.nodes=[] ## nodes is a list of node objects in tree
         self.leaves=[] ## leaves is a list of leaf objects in tree
+        self.tipOrder=[] ## tips in preorder, each node's descendant tips are a slice of it (see _index_tips())
+        self._lca=None ## lca_index for commonAncestor(), built when first needed and dropped whenever tips are renumbered
         self.tipMap=None
         self.treeHeight=0 ## tree height is the distance between the root and the most recent tip
         self.ySpan=0.0
+        self.xs=None ## NumPy arrays of x and y coordinates in the order of Objects, set by drawTree()
+        self.ys=None
+        self.layout=None ## which of drawTree(), drawUnrooted() or drawRadial() produced the coordinates
+        self.thetas=None ## NumPy arrays of angles and distances from the centre in the order of Objects, set by drawRadial()
+        self.radii=None
+        self._radial=None ## arguments of the last drawRadial() call
+        self.deferRefresh=False ## if True, edits only mark derived quantities stale until refresh() is called
+        self.sortedDescending=None ## direction of the last sortBranches() call
+        self._clear_stale()
+
+    def _clear_stale(self):
+        """ Forget about any stale derived quantities. """
+        self._stale={'heights':[], ## branches below which heights are stale
+                     'leaves':[], ## nodes from which descendant tips, numChildren and childHeight are stale all the way to the root
+                     'childHeight':[], ## nodes whose childHeight waits for a pending sort, since it depends on the order of children
+                     'sort':None, ## direction of a pending sortBranches(), if any
+                     'sortFrom':[], ## nodes whose children (and those of their ancestors) need sorting
+                     'sortAll':False, ## every node needs sorting
+                     'layout':False} ## x and y coordinates are stale
+
+    def invalidate(self,k=None,heights=False,leaves=False,sort=None,layout=True):
+        """ Mark quantities derived from branch k (or a list of branches) stale after an edit to the tree, k=None marks the whole tree.
+        heights: branch lengths at or below k have changed.
+        leaves: descendant tips of k (and its ancestors) have changed.
+        sort: direction (descending or not) in which to re-sort children of k and its ancestors, None to leave ordering alone.
+        layout: x and y coordinates need to be redrawn.
+        Everything stale is recomputed straight away unless self.deferRefresh is True, then call refresh() once edits are done. """
+        if isinstance(k,list):
+            branches=k
+        else:
+            branches=[self.root if k==None else k]
+        if heights==True:
+            self._stale['heights']+=branches
+        if leaves==True:
+            self._stale['leaves']+=branches
+        if sort!=None:
+            if k==None or (self._stale['sort']!=None and self._stale['sort']!=sort): ## conflicting directions - the last one wins everywhere
+                self._stale['sortAll']=True
+            self._stale['sort']=sort
+            self._stale['sortFrom']+=branches
+        if layout==True:
+            self._stale['layout']=True
+        if self.deferRefresh==False:
+            self.refresh()
+
+    def refresh(self,layout=True):
+        """ Recompute derived quantities marked stale by invalidate(): heights below edited branches, descendant tips,
+        numChildren and childHeight along the paths from edited branches to the root, ordering of children around them
+        and x and y coordinates. Does nothing if nothing is stale.
+        layout=False only brings heights and descendant tips up to date and leaves any sorting and drawing for later,
+        along with childHeight where a pending sort may reorder children (childHeight depends on the last child). """
+        stale=self._stale
+        if len(stale['heights'])>0 or len(stale['leaves'])>0:
+            path=stale['leaves']
+            heights=stale['heights']
+            stale['leaves']=[]
+            stale['heights']=[]
+            below=[] ## nodes below edited branches, children before their parents
+            done=set()
+            for k in sorted(heights,key=lambda w:0.0 if w.height==None else w.height): ## higher up first, so no subtree is walked twice
+                if id(k) in done:
+                    continue
+                if k.parent!=None:
+                    k.height=k.parent.height+float(k.length)
+                elif k.height==None:
+                    k.height=0.0
+                preorder=self._preorder(k)
+                for w in preorder[1:]:
+                    w.height=w.parent.height+float(w.length)
+                done.update(map(id,preorder))
+                below+=[w for w in reversed(preorder) if w.branchType=='node']
+                path.append(k.parent if k.parent!=None else k)
+
+            self.leaves=[k for k in self.Objects if isinstance(k,leaf_base)]
+            self.nodes=[k for k in self.Objects if isinstance(k,node_base)]
+            summarised=below+self._ancestors(path) ## deepest nodes first
+            for k in summarised:
+                self._summarise(k,childHeight=stale['sort']==None) ## sorting needs numChildren, childHeight has to wait for it
+            if stale['sort']!=None:
+                stale['childHeight']+=summarised
+            self.treeHeight=float(max([0]+[k.height for k in self.Objects if k.branchType=='leaf']))
+            if layout==False or (stale['sort']==None and stale['layout']==False): ## otherwise tips are numbered before drawing below
+                self._index_tips()
+
+        if layout==False or (stale['sort']==None and stale['layout']==False):
+            return
+
+        pending=set() ## nodes whose childHeight has to follow a new order of children
+        if stale['sort']!=None:
+            modifier=-1 if stale['sort']==True else 1
+            if self.sortedDescending==stale['sort'] and stale['sortAll']==False: ## everything else is already sorted this way
+                resorted=self._ancestors(stale['sortFrom'])
+                for k in resorted:
+                    if k!=self.root:
+                        self._sort_children(k,modifier)
+            else:
+                resorted=self.nodes
+                for k in resorted:
+                    self._sort_children(k,modifier)
+            pending=set(map(id,resorted+stale['childHeight'])) ## along with all of their ancestors
+            self.sortedDescending=stale['sort']
+        self._clear_stale()
+        layout=self.layout
+        preorder=self._preorder(self.root)
+        if len(pending)>0:
+            for k in reversed(preorder): ## children before their parents
+                if id(k) in pending:
+                    self._summarise(k)
+        self._index_tips(preorder) ## order of tips may have changed
+        self.drawTree(order=[k for k in preorder if k.branchType=='leaf'])
+        if layout=='radial': ## keep the tree radial
+            self.drawRadial(*self._radial)
+
+    def _ancestors(self,branches):
+        """ Nodes that are or are ancestral to any of the given branches, each once, deepest first. """
+        depth={}
+        for k in branches:
+            lineage=[]
+            while k!=None and id(k) not in depth:
+                if k.branchType=='node':
+                    lineage.append(k)
+                k=k.parent
+            base=0 if k==None else depth[id(k)][0]+1
+            for i,w in enumerate(reversed(lineage)):
+                depth[id(w)]=(base+i,w)
+        return [w for d,w in sorted(depth.values(),key=lambda x:-x[0])]
+
+    def _preorder(self,startNode):
+        """ Branches at and below startNode, parents before their children and children in their current order. """
+        preorder=[]
+        stack=[startNode]
+        while stack:
+            k=stack.pop()
+            preorder.append(k)
+            if k.branchType=='node':
+                stack.extend(reversed(k.children)) ## first child is visited next
+        return preorder
+
+    def _summarise(self,k,childHeight=True):
+        """ Set numChildren of node k from its children, and childHeight (unless childHeight is False) the way the original traversal did:
+        the tip height reached through k's last child (the last one with any tips), unless k already had a higher value (or 0). """
+        numChildren=0
+        lastTip=None
+        for child in k.children:
+            if child.branchType=='leaf':
+                numChildren+=1
+                tipHeight=child.height
+            else:
+                numChildren+=child.numChildren
+                tipHeight=child.childHeight
+            if tipHeight!=None: ## nodes without tips have no childHeight
+                lastTip=tipHeight
+        k.numChildren=numChildren
+        if childHeight==True and lastTip!=None:
+            k.childHeight=max(0 if k.childHeight==None else k.childHeight,lastTip)
+
+    def _index_tips(self,preorder=None):
+        """ Number tips in preorder (self.tipOrder) and give every node the range [firstTip, lastTip) of its descendant tips in it,
+        every tip its position. preorder is the preorder of the whole tree, if already at hand. """
+        if preorder==None:
+            preorder=self._preorder(self.root)
+        tips=[] ## a new list every time, branches that have left the tree keep the old one
+        for k in preorder:
+            k.firstTip=len(tips)
+            if k.branchType=='leaf':
+                tips.append(k)
+            else:
+                k._tips=tips
+        for k in reversed(preorder): ## a node's tips end where those of its last child do
+            if k.branchType=='node':
+                if len(k.children)==0:
+                    k.lastTip=k.firstTip
+                else:
+                    last=k.children[-1]
+                    k.lastTip=last.firstTip+1 if last.branchType=='leaf' else last.lastTip
+        self.tipOrder=tips
+        self._lca=None
+
+    def _sort_children(self,k,modifier):
+        """ Sort children of node k, descendant nodes by number of tips then branch length, tips by branch length. """
+        ## split node's offspring into nodes and leaves, sort each list individually
+        nodes=sorted([x for x in k.children if x.branchType=='node'],key=lambda q:(-q.numChildren*modifier,q.length*modifier))
+        leaves=sorted([x for x in k.children if x.branchType=='leaf'],key=lambda q:q.length*modifier)
+
+        if modifier==1: ## if sorting one way - nodes come first, leaves later
+            k.children=nodes+leaves
+        elif modifier==-1: ## otherwise sort the other way
+            k.children=leaves+nodes
 
     def add_node(self,i):
         """ Attaches a new node to current node. """
-        new_node=node() ## new node instance
+        new_node=compact_node() if self.compact else node() ## new node instance
         new_node.index=i ## new node's index is the position along the tree string
         new_node.parent=self.cur_node ## new node's parent is current node
         self.cur_node.children.append(new_node) ## new node is a child of current node
@@ -89,7 +619,7 @@ class tree: ## tree class
 
     def add_leaf(self,i,name):
         """ Attach a new leaf (tip) to current node. """
-        new_leaf=leaf() ## new instance of leaf object
+        new_leaf=compact_leaf() if self.compact else leaf() ## new instance of leaf object
         new_leaf.index=i ## index is position along tree string
         new_leaf.numName=name ## numName is the name tip has inside tree string, BEAST trees usually have numbers for tip names
         new_leaf.parent=self.cur_node ## leaf's parent is current node
@@ -98,62 +628,60 @@ class tree: ## tree class
         self.Objects.append(self.cur_node) ## add leaf to all objects in the tree
         self.leaves.append(self.cur_node)
 
-    def subtree(self,k=None,subtree=[],traitName=None,converterDict=None):
+    def subtree(self,k=None,subtree=[],traitName=None,converterDict=None,view=False):
         """ Generate a subtree (as a baltic tree object) from a traversal.
         If a trait name is provided the traversal occurs within the trait value of the starting node.
         Note - trait-specific traversal can result in multitype trees.
-        If this is undesired call singleType() on the resulting subtree afterwards. """
+        If this is undesired call singleType() on the resulting subtree afterwards.
+        view=True returns a subtree_view that shares branches with this tree instead of copying them. """
+        self.refresh(layout=False)
         if len(subtree)==0:
             if traitName:
-                subtree=copy.deepcopy(self.traverseWithinTrait(k,traitName,converterDict))
+                subtree=self.traverseWithinTrait(k,traitName,converterDict)
             else:
-                subtree=copy.deepcopy(self.traverse_tree(k,include_all=True))
-        else:
-            subtree=copy.deepcopy(subtree)
+                subtree=self._preorder(self.root if k==None else k)
 
         if subtree is None or [w.branchType=='leaf' for w in subtree].count(True)==0:
             return None
-        else:
-            local_tree=tree() ## create a new tree object where the subtree will be
-            local_tree.Objects=subtree ## assign branches to new tree object
-            local_tree.root.children.append(subtree[0]) ## connect tree object's root with subtree
-            subtree[0].parent=local_tree.root ## subtree's root's parent is tree object's root
-            local_tree.root.absoluteTime=subtree[0].absoluteTime-subtree[0].length ## root's absolute time is subtree's root time
-
-            if traitName: ## relying on within-trait traversal
-                for nd in local_tree.Objects:
-                    if nd.branchType=='node':
-                        nd.children=[ch for ch in nd.children if ch in subtree] ## prune each node's children down to branches that were present in the traversal
-                hangingNodes=[h for h in local_tree.Objects if h.branchType=='node' and len(h.children)==0] ## check for nodes without any children (hanging nodes)
-                while len(hangingNodes)>0:
-                    for h in sorted(hangingNodes,key=lambda x:-x.height):
-                        h.parent.children.remove(h) ## remove old parent from grandparent's children
-                        hangingNodes.remove(h) ## remove old parent from multitype nodes
-                        local_tree.Objects.remove(h) ## remove old parent from all objects
-                    hangingNodes=[h for h in local_tree.Objects if h.branchType=='node' and len(h.children)==0]
-
-            local_tree.sortBranches() ## sort branches, draw small tree
+        local_tree=subtree_view(self,subtree,prune=traitName!=None)
+        if view==True:
             return local_tree
-
-    def singleType(self):
-        """ Removes any branches with a single child (multitype nodes). """
-        multiTypeNodes=[k for k in self.Objects if k.branchType=='node' and len(k.children)==1]
-        while len(multiTypeNodes)>0:
-            multiTypeNodes=[k for k in self.Objects if k.branchType=='node' and len(k.children)==1]
-            for k in sorted(multiTypeNodes,key=lambda x:-x.height):
-                child=k.children[0] ## fetch child
-                grandparent=k.parent ## fetch grandparent
-
-                child.parent=grandparent ## child's parent is now grandparent
-
-                grandparent.children.append(child) ## add child to grandparent's children
-                grandparent.children.remove(k) ## remove old parent from grandparent's children
-
-                child.length+=k.length ## adjust child length
-
-                multiTypeNodes.remove(k) ## remove old parent from multitype nodes
-                self.Objects.remove(k) ## remove old parent from all objects
-        self.sortBranches()
+        return local_tree.materialize()
+
+    def singleType(self,changePoints=False):
+        """ Removes any branches with a single child (multitype nodes), adding their lengths to the branch below.
+        Each chain of single-child nodes is spliced out in one pass over the tree.
+        changePoints=True keeps what the removed nodes recorded (e.g. type changes along a structured coalescent branch)
+        as a 'changePoints' trait of the branch below them: a list of (height, traits) tuples ordered from the root towards the tips. """
+        self.refresh(layout=False)
+        removed=set()
+        moved=[]
+        for k in reversed(self._preorder(self.root)): ## branches below are dealt with before their parents
+            if k.branchType!='node' or (len(k.children)==1 and k!=self.root):
+                continue
+            children=[]
+            spliced=[]
+            for top in k.children:
+                if top.branchType!='node' or len(top.children)!=1:
+                    children.append(top)
+                    continue
+                chain=[top]
+                while chain[-1].children[0].branchType=='node' and len(chain[-1].children[0].children)==1: ## follow single-child nodes down
+                    chain.append(chain[-1].children[0])
+                child=chain[-1].children[0]
+                for w in reversed(chain): ## lengths are added from the bottom up
+                    child.length+=w.length
+                    removed.add(id(w))
+                if changePoints==True:
+                    child.traits['changePoints']=[(w.height,dict(w.traits)) for w in chain]+list(child.traits.get('changePoints',[]))
+                child.parent=k ## child's parent is now grandparent
+                spliced.append((top,child))
+            if len(spliced)>0:
+                k.children=children+[child for top,child in sorted(spliced,key=lambda x:-x[0].height)] ## spliced children go to the end, as before
+                moved+=[child for top,child in spliced]
+        self.Objects=[k for k in self.Objects if id(k) not in removed] ## remove old parents from all objects
+        self.nodes=[k for k in self.nodes if id(k) not in removed]
+        self.invalidate(moved,heights=True,leaves=True,sort=True) ## spliced children have longer branches, grandparents new children to sort
 
     def setAbsoluteTime(self,date):
         """ place all objects in absolute time by providing the date of the most recent tip """
@@ -161,6 +689,19 @@ class tree: ## tree class
         for i in self.Objects: ## iterate over all objects
             i.absoluteTime=date-self.treeHeight+i.height ## heights are in units of time from the root
 
+    def internTraitKeys(self,table=None):
+        """ Make every branch use one shared string object per trait name instead of its own copy.
+        table is a dictionary of trait names to reuse, e.g. one shared across the trees of a posterior sample. Returns the table.
+        Lazily decoded traits are left alone. """
+        if table is None:
+            table={}
+        for k in [self.root]+self.Objects:
+            traits=k.traits
+            if isinstance(traits,lazy_traits) or dict.__len__(traits)==0:
+                continue
+            k.traits={table.setdefault(key,key):value for key,value in traits.items()}
+        return table
+
     def treeStats(self):
         """ provide information about the tree """
         self.traverse_tree() ## traverse the tree
@@ -200,125 +741,50 @@ class tree: ## tree class
 
     def traverse_tree(self,startNode=None,include_all=False,verbose=False):
         """ Traverses tree from root. If a starting node is not defined begin traversal from root.
+        Sets heights of every branch below the starting node, and the number of descendant tips (numChildren)
+        and childHeight (see _summarise()) of every node below it.
+        Tips are then numbered in preorder across the whole tree (see _index_tips()), giving every node its descendant tips (leaves).
         By default returns a list of leaf objects that have been visited,
         optionally returns a list of all objects in the tree. """
         if startNode==None: ## if no starting point defined - start from root
-            cur_node=self.root
-            start=None ## remember that traversal was started from scratch
-            startNode=cur_node
+            startNode=self.root
         elif startNode.branchType=='leaf':
-            start=startNode
             if include_all==True:
                 return [startNode]
             else:
                 return [startNode.numName]
-        else:
-            start=startNode
-            cur_node=startNode ## otherwise start from starting node
 
-        self.leaves=[k for k in self.Objects if isinstance(k,leaf)]
-        self.nodes=[k for k in self.Objects if isinstance(k,node)]
+        self.leaves=[k for k in self.Objects if isinstance(k,leaf_base)]
+        self.nodes=[k for k in self.Objects if isinstance(k,node_base)]
 
         if verbose==True:
             print('Verbose traversal initiated')
 
-        for k in self.Objects: ## reset leaves and number of children for every node
-            if isinstance(k,node):
-                k.leaves=[]
-                k.numChildren=0
+        if startNode==self.root: ## everything is about to be recomputed
+            self._stale['heights']=[]
+            self._stale['leaves']=[]
+            self._stale['childHeight']=[]
+        if startNode.height==None:
+            startNode.height=0.0 ## begin at height 0.0
 
-        seen=[] ## remember what's been visited
-        collected=[] ## collect leaf objects along the way
-        maxHeight=0 ## check what the maximum distance between the root and the most recent tip is
-        if startNode!=None and startNode.height!=None:
-            height=startNode.height
-        else:
-            height=0.0 ## begin at height 0.0
+        preorder=self._preorder(startNode) ## every branch once, parents before their children
+        for cur_node in preorder[1:]:
+            cur_node.height=cur_node.parent.height+float(cur_node.length) ## height is parent's height plus branch length
 
-        root=False ## root becomes true once you're unable to go back any further
-
-        while root==False: ## cycle indefinitely as long as there's more of the tree to explore
-            if seen.count(cur_node.index)>3:
-                if verbose==True:
-                    print('node %s seen too many times, breaking'%(cur_node.index))
-                root=True
-                break
-
-            if cur_node.branchType=='node': ## if currently dealing with a node
-                if verbose==True:
-                    print('encountered node %s'%(cur_node.index))
-                if include_all==True: ## if node hasn't been collected and we want to collect all objects - add it for reporting later
-                    collected.append(cur_node)
-                # check whether all children of the node have been seen ,
-                # or whether we're not currently at the root
-                # as long as all children have been seen will descend downwards
-                while sum([1 if x.index in seen else 0 for x in cur_node.children])==len(cur_node.children) and cur_node!=startNode.parent:
-                    if verbose==True:
-                        print('seen all children of node %s'%(cur_node.index))
-
-                    # New necessary logical modification for py3
-                    # Inits at None; must be overriden to 0 at the leaves
-                    if cur_node.childHeight is None:
-                        cur_node.childHeight = 0
-
-                    ## check whether current node's most recent child is higher than the known highest point in the tree
-                    if cur_node.childHeight <= highestTip:
-                        cur_node.childHeight = highestTip
-                    elif cur_node.childHeight > highestTip:
-                        highestTip = cur_node.childHeight
-
-                    if cur_node.index==startNode.index: ## if currently at root - set the root flag to True and break the while loop
-                        if verbose==True:
-                            print('reached starting point %s'%(cur_node.index))
-                        cur_node.height=height
-                        root=True
-                        break
-                    else: ## otherwise...
-                        if verbose==True:
-                            print('heading to parent of %s'%(cur_node.index))
-                        cur_node.parent.numChildren+=cur_node.numChildren ## add the number of current node's children to its parent
-                        cur_node.parent.leaves+=cur_node.leaves ## add the list of tip names descended from current node to its parent
-                        cur_node.parent.leaves=unique(cur_node.parent.leaves) ## reduce to only unique names
-                        cur_node.parent.leaves=sorted(cur_node.parent.leaves) ## sort children
-                        cur_node.height=height ## set height
-                        height-=float(cur_node.length) ## prepare height value for the eventual descent downwards in the tree
-                        cur_node=cur_node.parent ## current node is now current node's parent
-
-                last_seen=[1 if x.index in seen else 0 for x in cur_node.children] ## put 1 for every child of the node that you have seen, 0 for every one that hasn't been seen
-
-                try: ## try finding the first unvisited child of a node
-                    idx_to_visit=last_seen.index(0)
-                except ValueError:
-                    idx_to_visit=0 ## no children seen yet
-
-                if verbose==True:
-                    print('visiting %s next (child of %s)'%(cur_node.children[idx_to_visit].index,cur_node.index))
-
-                cur_node.height=height ## set height of current node
-                height+=float(cur_node.children[idx_to_visit].length) ## prepare for heading towards the previously unvisited child branch
-                cur_node=cur_node.children[idx_to_visit] ## set current node to unvisited child
-                seen.append(cur_node.index) ## remember that the child has now been visited
-
-            elif cur_node.branchType=='leaf': ## node dealing with node, are we dealing with a leaf (tip)?
+        maxHeight=0 ## check what the maximum distance between the root and the most recent tip is
+        for cur_node in reversed(preorder): ## children are always dealt with before their parents
+            if cur_node.branchType=='node':
+                self._summarise(cur_node)
                 if verbose==True:
-                    print('encountered leaf %s (%s or %s)'%(cur_node.index,cur_node.numName,cur_node.name))
-                cur_node.parent.numChildren+=1 ## parent has one more new child (congratulations!)
-                cur_node.parent.leaves.append(cur_node.numName) ## add the name of leaf to its parent's list of children names
-                cur_node.parent.leaves=sorted(cur_node.parent.leaves) ## sort parent's children list
-                seen.append(cur_node.index) ## leaf has now officially been seen
-                highestTip=float(height) ## set the height of the leaf as being potentially the highest tip
-                cur_node.height=height ## set leaf's height
-
-                #if cur_node not in collected: ## if leaf hasn't been collected - add it for reporting later
-                collected.append(cur_node)
-                if maxHeight<=float(cur_node.height): ## is this the highest point we've seen in the tree so far?
-                    maxHeight=float(cur_node.height)
-
-                height-=float(cur_node.length) ## prepare for heading back
-                cur_node=cur_node.parent ## current node is now leaf's parent
+                    print('node %s has %d descendant tips'%(cur_node.index,cur_node.numChildren))
+            elif maxHeight<=float(cur_node.height): ## is this the highest point we've seen in the tree so far?
+                maxHeight=float(cur_node.height)
 
         self.treeHeight=float(maxHeight) ## tree height of this tree is the height of the highest tip
-        return unique(collected) ## return a list of collected leaf objects
+        self._index_tips(preorder if startNode==self.root else None)
+        if include_all==True:
+            return preorder
+        return [k for k in preorder if k.branchType=='leaf'] ## return a list of collected leaf objects
 
     def renameTips(self,d):
         """ Give each tip its correct label using a dictionary. """
@@ -326,6 +792,7 @@ class tree: ## tree class
             d=self.tipMap
         for k in self.leaves: ## iterate through leaf objects in tree
             k.name=d[k.numName] ## change its name
+        self._lca=None ## tip names are looked up there
 
     def sortBranches(self,descending=True):
         """ Sort descendants of each node. """
@@ -334,95 +801,138 @@ class tree: ## tree class
         elif descending==False:
             modifier=1
 
+        self._stale['sort']=None ## this sort and the redraw below replace any pending ones
+        self._stale['sortFrom']=[]
+        self._stale['sortAll']=False
+        self._stale['layout']=False
+        self.refresh(layout=False) ## sorting relies on up to date descendant tips
+
         for k in self.Objects: ## iterate over nodes
             if k.branchType=='node':
-                ## split node's offspring into nodes and leaves, sort each list individually
-                nodes=sorted([x for x in k.children if x.branchType=='node'],key=lambda q:(-len(q.leaves)*modifier,q.length*modifier))
-                leaves=sorted([x for x in k.children if x.branchType=='leaf'],key=lambda q:q.length*modifier)
-
-                if modifier==1: ## if sorting one way - nodes come first, leaves later
-                    k.children=nodes+leaves
-                elif modifier==-1: ## otherwise sort the other way
-                    k.children=leaves+nodes
+                self._sort_children(k,modifier)
         self.nodes=[k for k in self.Objects if k.branchType=='node']
+        self.sortedDescending=descending
         self.drawTree() ## update x and y positions of each branch, since y positions will have changed because of sorting
 
     def drawTree(self,order=None):
-        """ Find x and y coordinates of each branch. """
+        """ Find x and y coordinates of each branch.
+        Tips are spread along y in the order given (by default the traversal order), collapsed clades take up their width
+        and nodes sit in the middle of their children. x is height.
+        Coordinates are also kept in self.xs and self.ys, NumPy arrays in the order of self.Objects. """
         if order==None:
             order=[x for x in self.traverse_tree() if x.branchType=='leaf'] ## order is a list of tips recovered from a tree traversal to make sure they're plotted in the correct order along the vertical tree dimension
+        self._stale['layout']=False
+
+        skips=[1 if isinstance(x,leaf_base) else x.width+1 for x in order]
 
-        name_order=[x.numName for x in order]
-        skips=[1 if isinstance(x,leaf) else x.width+1 for x in order]
+        tip_y={} ## y position of each tip name is the sum of skips from the tip to the end of the order
+        y=0
+        for k,skip in zip(reversed(order),reversed(skips)):
+            y+=skip
+            tip_y[k.numName]=(y,skip) ## a repeated name ends up with the position of its first occurrence
 
         for k in self.Objects: ## reset coordinates for all objects
             k.x=None
             k.y=None
 
-        storePlotted=0
-        drawn=[] ## drawn keeps track of what's been drawn
-        while len(drawn)!=len(self.Objects): # keep drawing the tree until everything is drawn
-            for k in [x for x in self.Objects if x.index not in drawn]: ## iterate through objects that have not been drawn
-                if k.branchType=='leaf': ## if leaf - get position of leaf, draw branch connecting tip to parent node
-                    x=k.height ## x position is height
-                    y_idx=name_order.index(k.numName) ## y position of leaf is given by the order in which tips were visited during the traversal
-                    y=sum(skips[y_idx:]) ## sum across skips to find y position
-                    if isinstance(k,clade): ## if dealing with collapsed clade - adjust y position to be in the middle of the skip
-                        y-=skips[y_idx]/2.0
-                    k.x=x ## set x and y coordinates
-                    k.y=y
-                    drawn.append(k.index) ## remember that this objects has been drawn
-
-                if k.branchType=='node': ## if parent is non-root node and y positions of all its children are known
-                    if len([q.y for q in k.children if q.y!=None])==len(k.children):
-                        x=k.height ## x position is height
-                        children_y_coords=[q.y for q in k.children if q.y!=None] ## get all existing y coordinates of the node
-                        y=sum(children_y_coords)/float(len(children_y_coords)) ## internal branch is in the middle of the vertical bar
-                        k.x=x
-                        k.y=y
-                        drawn.append(k.index) ## remember that this objects has been drawn
-
-            assert len(drawn)>storePlotted,'Got stuck trying to find y positions of objects'
-            storePlotted=len(drawn)
-            self.ySpan=sum(skips)
-
-    def drawUnrooted(self,n=None,total=None):
+        for k in reversed(self._preorder(self.root)): ## children are placed before their parents
+            if k==self.root:
+                continue
+            k.x=k.height ## x position is height
+            if k.branchType=='leaf':
+                y,skip=tip_y[k.numName]
+                if isinstance(k,clade_base): ## if dealing with collapsed clade - adjust y position to be in the middle of the skip
+                    y-=skip/2.0
+                k.y=y
+            else: ## internal branch is in the middle of the vertical bar
+                k.y=sum([q.y for q in k.children])/float(len(k.children))
+
+        self.xs=np.array([np.nan if k.x==None else k.x for k in self.Objects],dtype=np.float64)
+        self.ys=np.array([np.nan if k.y==None else k.y for k in self.Objects],dtype=np.float64)
+        self.ySpan=sum(skips)
+        self.layout='rectangular'
+
+    def drawUnrooted(self,n=None,total=None,daylight=0):
         """
         Calculate x and y coordinates in an unrooted arrangement.
         Code translated from https://github.com/nextstrain/auspice/commit/fc50bbf5e1d09908be2209450c6c3264f298e98c,
         written by Richard Neher.
+        Equal-angle layout of branches below n (by default the whole tree), computed iteratively.
+        Coordinates are also kept in self.xs and self.ys, NumPy arrays in the order of self.Objects.
+        daylight: maximum number of equal-daylight passes (see equal_daylight()) to refine the layout with, 0 (default) for none.
         """
+        self.refresh(layout=False)
+        if total==None:
+            total=sum([1 if isinstance(x,leaf_base) else x.width+1 for x in [w for w in self.Objects if w.branchType=='leaf']])
         if n==None:
-            total=sum([1 if isinstance(x,leaf) else x.width+1 for x in [w for w in self.Objects if w.branchType=='leaf']])
             n=self.root.children[0]
             for k in self.Objects:
-                k.traits['tau']=0.0
                 k.x=0.0
                 k.y=0.0
-
-        if n.branchType=='leaf':
-            w=2*math.pi*1.0/float(total)
-        else:
-            w=2*math.pi*len(n.leaves)/float(total)
-
         if n.parent.x==None:
             n.parent.x=0.0
             n.parent.y=0.0
 
-        n.x = n.parent.x + n.length * math.cos(n.traits['tau'] + w*0.5)
-        n.y = n.parent.y + n.length * math.sin(n.traits['tau'] + w*0.5)
-        eta=n.traits['tau']
-
-        if n.branchType=='node':
-            for ch in n.children:
-                if ch.branchType=='leaf':
-                    w=2*math.pi*1.0/float(total)
-                else:
-                    w=2*math.pi*len(ch.leaves)/float(total)
-                ch.traits['tau'] = eta
-                eta += w
-                self.drawUnrooted(ch,total)
+        preorder=[n.parent]+self._preorder(n) ## parent of the first branch anchors the layout
+        position={id(k):i for i,k in enumerate(preorder)}
+        parent=[-1]+[position[id(k.parent)] for k in preorder[1:]]
+        w=[0.0]+[2*math.pi*(1.0 if k.branchType=='leaf' else k.numChildren)/float(total) for k in preorder[1:]] ## angle taken up by each branch
 
+        tau=[0.0]*len(preorder) ## each branch's wedge starts where the wedge of its previous sibling ends
+        for i,k in enumerate(preorder[1:],start=1):
+            if k.branchType=='node':
+                eta=tau[i]
+                for ch in k.children:
+                    j=position[id(ch)]
+                    tau[j]=eta
+                    eta+=w[j]
+
+        angle=np.array(tau)+np.array(w)*0.5
+        length=np.array([0.0]+[k.length for k in preorder[1:]],dtype=np.float64)
+        dx=(length*np.cos(angle)).tolist()
+        dy=(length*np.sin(angle)).tolist()
+        x=[n.parent.x]+[0.0]*(len(preorder)-1)
+        y=[n.parent.y]+[0.0]*(len(preorder)-1)
+        for i in range(1,len(preorder)): ## parents are placed before their children
+            x[i]=x[parent[i]]+dx[i]
+            y[i]=y[parent[i]]+dy[i]
+
+        x=np.array(x)
+        y=np.array(y)
+        if daylight>0:
+            equal_daylight(x,y,np.array(parent),np.array([k.branchType=='leaf' for k in preorder]),passes=daylight)
+
+        for k,kx,ky in zip(preorder[1:],x[1:].tolist(),y[1:].tolist()):
+            k.x=kx
+            k.y=ky
+        self.xs=np.array([np.nan if k.x==None else k.x for k in self.Objects],dtype=np.float64)
+        self.ys=np.array([np.nan if k.y==None else k.y for k in self.Objects],dtype=np.float64)
+        self.layout='unrooted'
+
+    def drawRadial(self,start=0.0,span=2*math.pi,gap=0.0):
+        """ Circular layout: the rectangular layout of drawTree() (reused if it is up to date) wrapped around the root.
+        Height becomes distance from the centre and position in the tip order becomes angle, counterclockwise from start.
+        span: angle covered by the tree in radians, less than 2*pi for a partial arc.
+        gap: empty angle left at the end of span, e.g. to separate the last tip from the first one on a full circle.
+        Angles and distances from the centre are kept in self.thetas and self.radii, x and y coordinates in self.xs and
+        self.ys (and each branch's x and y), all NumPy arrays in the order of self.Objects. """
+        self.refresh(layout=False)
+        if self._stale['sort']!=None or self._stale['layout']==True:
+            self.layout=None ## pending sorting and redrawing give the rectangular layout to start from
+            self.refresh()
+        if self.layout!='rectangular' or self.xs is None or len(self.xs)!=len(self.Objects):
+            self.drawTree(order=[k for k in self._preorder(self.root) if k.branchType=='leaf'])
+
+        ySpan=float(self.ySpan) if self.ySpan>0 else 1.0
+        self.radii=np.nan_to_num(self.xs-self.root.height,nan=0.0) ## branches without coordinates sit in the centre
+        self.thetas=np.nan_to_num(start+self.ys*((span-gap)/ySpan),nan=start)
+        self.xs=self.radii*np.cos(self.thetas)
+        self.ys=self.radii*np.sin(self.thetas)
+        for k,kx,ky in zip(self.Objects,self.xs.tolist(),self.ys.tolist()):
+            k.x=kx
+            k.y=ky
+        self.layout='radial'
+        self._radial=(start,span,gap)
 
     def traverseWithinTrait(self,startNode,traitName,converterDict=None):
         """ Traverse the tree staying within the trait value of the node provided.
@@ -439,7 +949,7 @@ class tree: ## tree class
 
         root=False
 
-        if isinstance(startNode,leaf): ## quit immediately if starting from a leaf - nowhere to go
+        if isinstance(startNode,leaf_base): ## quit immediately if starting from a leaf - nowhere to go
             collected.append(startNode)
             return collected
 
@@ -457,7 +967,7 @@ class tree: ## tree class
                 return None
 
         while root==False:
-            if isinstance(cur_node,node):
+            if isinstance(cur_node,node_base):
                 ## if all children have been seen and not at root
                 while sum([1 if child.index in seen else 0 for child in cur_node.children])==len(cur_node.children) and cur_node.parent!=self.root:
 
@@ -493,52 +1003,53 @@ class tree: ## tree class
                 else: ## otherwise head back, nothing to see any more
                     cur_node=cur_node.parent
 
-            elif isinstance(cur_node,leaf):
+            elif isinstance(cur_node,leaf_base):
                 seen.append(cur_node.index)
                 if cur_node not in collected:
                     collected.append(cur_node)
                 cur_node=cur_node.parent
 
     def commonAncestor(self,descendants,numName=False):
+        """ Most recent node ancestral to all tips with the given names (numNames if numName is True).
+        Answered by an index built once per tree topology (see lca_index), so repeated calls are cheap. """
         types=[desc.__class__ for desc in descendants]
         assert len(set(types))==1,'More than one type of data detected in descendants list'
-        if numName==False:
-            assert sum([1 if k in [w.name for w in self.Objects if w.branchType=='leaf'] else 0 for k in descendants])==len(descendants),'Not all specified descendants are in tree: %s'%(descendants)
-        else:
-            assert sum([1 if k in [w.numName for w in self.Objects if w.branchType=='leaf'] else 0 for k in descendants])==len(descendants),'Not all specified descendants are in tree: %s'%(descendants)
-        dtype=list(set(types))[0]
-        allAncestors=sorted([k for k in self.Objects if k.branchType=='node' and len(k.leaves)>=len(descendants)],key=lambda x:x.height)
-        if numName==False:
-            ancestor=[k for k in allAncestors if sum([[self.tipMap[w] for w in k.leaves].count(l) for l in descendants])==len(descendants)][-1]
-        else:
-            ancestor=[k for k in allAncestors if sum([[w for w in k.leaves].count(l) for l in descendants])==len(descendants)][-1]
-        return ancestor
+        return self.commonAncestors([descendants],numName=numName)[0]
+
+    def commonAncestors(self,groups,numName=False):
+        """ Most recent common ancestor of each group (a list of tip names, or numNames if numName is True) in groups.
+        The index behind it is rebuilt after any change to the tree's topology, tip order or tip names. """
+        self.refresh(layout=False)
+        if self._lca==None:
+            self._lca=lca_index(self)
+        return self._lca.commonAncestors(groups,numName=numName)
 
     def collapseSubtree(self,cl,givenName,verbose=False,widthFunction=lambda x:x):
         """ Collapse an entire subtree into a clade object. """
         assert cl.branchType=='node','Cannot collapse non-node class'
-        collapsedClade=clade(givenName)
+        self.refresh(layout=False)
+        collapsedClade=compact_clade(givenName) if self.compact else clade(givenName)
         collapsedClade.index=cl.index
         collapsedClade.length=cl.length
         collapsedClade.height=cl.height
         collapsedClade.parent=cl.parent
         collapsedClade.absoluteTime=cl.absoluteTime
         collapsedClade.traits=cl.traits
-        collapsedClade.width=widthFunction(len(cl.leaves))
+        collapsedClade.width=widthFunction(cl.lastTip-cl.firstTip)
 
         if verbose==True:
             print('Replacing node %s (parent %s) with a clade class'%(cl.index,cl.parent.index))
         parent=cl.parent
         #collapsedClade.subtree=cl
 
-        remove_from_tree=self.traverse_tree(cl,include_all=True)
+        remove_from_tree=self._preorder(cl)
         collapsedClade.subtree=remove_from_tree
         assert len(remove_from_tree)<len(self.Objects),'Attempted collapse of entire tree'
         collapsedClade.lastHeight=max([x.height for x in remove_from_tree])
         collapsedClade.lastAbsoluteTime=max([x.absoluteTime for x in remove_from_tree])
 
-        for k in remove_from_tree:
-            self.Objects.remove(k)
+        removed=set(map(id,remove_from_tree))
+        self.Objects[:]=[k for k in self.Objects if id(k) not in removed]
 
         parent.children.remove(cl)
         parent.children.append(collapsedClade)
@@ -547,13 +1058,13 @@ class tree: ## tree class
         if self.tipMap!=None:
             self.tipMap[givenName]=givenName
 
-        self.traverse_tree()
-        self.sortBranches()
+        self.invalidate(parent,leaves=True,sort=True) ## only the path from the clade to the root has new descendant tips
 
     def uncollapseSubtree(self):
         """ Uncollapse all collapsed subtrees. """
-        while len([k for k in self.Objects if isinstance(k,clade)])>0:
-            clades=[k for k in self.Objects if isinstance(k,clade)]
+        parents=[]
+        while len([k for k in self.Objects if isinstance(k,clade_base)])>0:
+            clades=[k for k in self.Objects if isinstance(k,clade_base)]
             for cl in clades:
                 parent=cl.parent
                 subtree=cl.subtree
@@ -561,235 +1072,1230 @@ class tree: ## tree class
                 parent.children.append(subtree[0])
                 self.Objects+=subtree
                 self.Objects.remove(cl)
+                parents.append(parent)
                 if self.tipMap!=None:
                     self.tipMap.pop(cl.name,None)
-        self.traverse_tree()
+        self.invalidate(parents,leaves=True,sort=self.sortedDescending) ## put restored subtrees back in order if the tree was sorted
+
+    def clone(self,deep=True):
+        """ Copy of the tree made branch by branch: children and parents are rewired to the copies and every branch gets
+        its own trait dictionary (with deep copies of the values if deep is True).
+        Much cheaper than copy.deepcopy() of the whole tree and free of its recursion limits.
+        Collapsed clades keep referring to the original collapsed branches. Anything stale in this tree is stale in the copy too. """
+        newTree=copy.copy(self)
+        copies={}
+        for k in self._preorder(self.root): ## parents are copied before their children
+            c=copy.copy(k)
+            traits=k.traits
+            if not isinstance(traits,_attach_on_write_dict): ## compact branches without traits stay without
+                c.traits=copy.deepcopy(traits) if deep else copy.copy(traits)
+            if k.parent!=None:
+                c.parent=copies[id(k.parent)]
+                c.parent.children.append(c)
+            if k.branchType=='node':
+                c.children=[]
+            copies[id(k)]=c
+
+        newTree.root=copies[id(self.root)]
+        newTree.cur_node=copies.get(id(self.cur_node),newTree.root)
+        newTree.Objects=[copies[id(k)] for k in self.Objects]
+        newTree.nodes=[copies[id(k)] for k in self.nodes]
+        newTree.leaves=[copies[id(k)] for k in self.leaves]
+        newTree.tipMap=None if self.tipMap==None else dict(self.tipMap)
+        for attr in ['xs','ys','thetas','radii']:
+            if getattr(self,attr) is not None:
+                setattr(newTree,attr,getattr(self,attr).copy())
+        newTree._stale={key:(list(value) if isinstance(value,list) else value) for key,value in self._stale.items()} ## own lists, so invalidating one tree leaves the other alone
+        for key in ['heights','leaves','childHeight','sortFrom']:
+            newTree._stale[key]=[copies[id(k)] for k in self._stale[key] if id(k) in copies]
+        newTree._index_tips()
+        return newTree
+
+    def _value_getter(self,trait,verbose=False):
+        """ Function returning a node's attribute called trait if every node has one, or its trait otherwise. """
+        if sum([1 if hasattr(q,trait) else 0 for q in self.nodes])==len(self.nodes): ## every node has attribute
+            if verbose==True:
+                print('Collapsing based on attribute')
+            return lambda ob,tr:getattr(ob,tr)
+        else: ## not every node has attribute - assume dealing with trait
+            if verbose==True:
+                print('Collapsing based on trait')
+            return lambda ob,tr:ob.traits[tr]
 
-    def collapseBranches(self,trait='posterior',f=lambda x:x<=0.5,designated_nodes=[],verbose=False):
+    def collapseBranches(self,trait='posterior',f=lambda x:x<=0.5,designated_nodes=[],verbose=False,inplace=False,deep=True):
         """ Collapse all branches according to whether an attribute or trait value (default is "posterior" trait) satisfies an anonymous function f (default is return true if value is <=0.5).
             Alternatively, a list of nodes can be supplied to the script.
-            Returns a deep copied version of the tree.
+            Returns a copied version of the tree (see clone(), deep is passed on to it), or this tree collapsed in place if inplace is True.
+            Collapsed nodes are removed in a single pass from the tips down, their children join the parent with branch lengths added up.
         """
-        newTree=copy.deepcopy(self) ## work on a copy of the tree
+        self.refresh(layout=False)
+        newTree=self if inplace==True else self.clone(deep=deep) ## work on a copy of the tree
         if len(designated_nodes)==0: ## no nodes were designated for deletion - relying on anonymous function to collapse nodes
-            if sum([1 if hasattr(q,trait) else 0 for q in newTree.nodes])==len(newTree.nodes): ## every node has attribute
-                def get_value(ob,tr):
-                    return getattr(ob,tr)
-                if verbose==True:
-                    print('Collapsing based on attribute')
-            else: ## not every node has attribute - assume dealing with trait
-                def get_value(ob,tr):
-                    return ob.traits[tr]
-                if verbose==True:
-                    print('Collapsing based on trait')
+            get_value=newTree._value_getter(trait,verbose=verbose)
             nodes_to_delete=[n for n in newTree.nodes if trait in n.traits and f(get_value(n,trait))==True] ## fetch a list of all nodes who are not the root and who satisfy the condition
         else:
             assert [w.branchType for w in designated_nodes].count('node')==len(designated_nodes),'Non-node class detected in list of nodes designated for deletion'
             assert len([w for w in designated_nodes if w.parent.index=='Root'])==0,'Root node was designated for deletion'
-            nodes_to_delete=[w for w in newTree.Objects if w.index in [q.index for q in designated_nodes]] ## need to look up nodes designated for deletion by their indices, since the tree has been copied and nodes will have new memory addresses
+            designated=set([q.index for q in designated_nodes])
+            nodes_to_delete=[w for w in newTree.Objects if w.index in designated] ## need to look up nodes designated for deletion by their indices, since the tree may have been copied
         if verbose==True:
             print('%s nodes set for collapsing: %s'%(len(nodes_to_delete),[w.index for w in nodes_to_delete]))
         assert len(nodes_to_delete)<len(newTree.nodes)-1,'Chosen cutoff would remove all branches'
-        while len(nodes_to_delete)>0: ## as long as there are branches to be collapsed - keep reducing the tree
-            if verbose==True:
-                print('Continuing collapse cycle, %s nodes left'%(len(nodes_to_delete)))
-            for k in sorted(nodes_to_delete,key=lambda x:-x.height): ## start with branches near the tips
-                zero_node=k.children ## fetch the node's children
-                k.parent.children+=zero_node ## add them to the zero node's parent
-                old_parent=k ## node to be deleted is the old parent
-                new_parent=k.parent ## once node is deleted, the parent to all their children will be the parent of the deleted node
-                if verbose==True:
-                    print('Removing node %s, attaching children %s to node %s'%(old_parent.index,[w.index for w in k.children],new_parent.index))
-                for w in newTree.Objects: ## assign the parent of deleted node as the parent to any children of deleted node
-                    if w.parent==old_parent:
-                        w.parent=new_parent
-                        w.length+=old_parent.length
-                        if verbose==True:
-                            print('Fixing branch length for node %s'%(w.index))
-                k.parent.children.remove(k) ## remove traces of deleted node - it doesn't exist as a child, doesn't exist in the tree and doesn't exist in the nodes list
-                newTree.Objects.remove(k)
-                newTree.nodes.remove(k)
-                nodes_to_delete.remove(k) ## in fact, the node never existed
+
+        deleted=set(map(id,nodes_to_delete))
+        moved=[]
+        for k in reversed(newTree._preorder(newTree.root)): ## children are dealt with before their parents
+            if k.branchType!='node' or len(deleted.intersection(map(id,k.children)))==0:
+                continue
+            children=[ch for ch in k.children if id(ch) not in deleted]
+            for old_parent in sorted([ch for ch in k.children if id(ch) in deleted],key=lambda x:-x.height): ## children of deleted nodes join the end, deepest deleted node first
                 if verbose==True:
-                    print('Removing references to node %s'%(k.index))
-        newTree.sortBranches() ## sort the tree to traverse, draw and sort tree to adjust y coordinates
+                    print('Removing node %s, attaching children %s to node %s'%(old_parent.index,[w.index for w in old_parent.children],k.index))
+                for w in old_parent.children: ## already include children of any deleted nodes below
+                    w.parent=k
+                    w.length+=old_parent.length
+                children+=old_parent.children
+                moved+=old_parent.children
+            k.children=children
+
+        newTree.Objects=[w for w in newTree.Objects if id(w) not in deleted] ## remove traces of deleted nodes
+        newTree.nodes=[w for w in newTree.nodes if id(w) not in deleted]
+        newTree.invalidate(moved,heights=True,leaves=True,sort=True) ## longer branches, new parents to sort, and a redraw to adjust y coordinates
         return newTree ## return collapsed tree
 
+    def collapseSweep(self,thresholds,trait='posterior',trees=False):
+        """ Summarise what collapseBranches(trait=trait,f=lambda x:x<=threshold) would do for each of a list of thresholds, without collapsing anything.
+            Nodes are sorted by support once and collapsed cumulatively from the lowest threshold up, each collapsed node merging into its closest surviving ancestor,
+            so the whole sweep costs about as much as a single pass over the tree. Support values are converted to floats (e.g. bootstrap node labels),
+            nodes without one are never collapsed.
+            Returns a list with a dictionary for every threshold (in the order given) holding the threshold, the number of resolved (surviving) and collapsed nodes
+            and the distribution of polytomy sizes ({number of children: number of nodes}). If trees is True each dictionary also gets a 'tree' function
+            that builds the collapsed tree with collapseBranches() when called.
+        """
+        self.refresh(layout=False)
+        get_value=self._value_getter(trait)
+        nodes=[self.root]+self.nodes ## position 0 is the root, which is never collapsed
+        position={id(k):i for i,k in enumerate(nodes)}
+        up=[0]+[position[id(k.parent)] for k in self.nodes] ## closest ancestor that may still survive
+        size=[len(k.children) for k in nodes] ## number of children each node has once collapsed nodes are spliced out
+        collapsed=[False]*len(nodes)
+
+        support=[]
+        for i,k in enumerate(self.nodes,start=1):
+            if trait not in k.traits:
+                continue
+            try:
+                support.append((float(get_value(k,trait)),i))
+            except (TypeError,ValueError): ## not a number - never collapsed
+                pass
+        support.sort()
+
+        polytomies={}
+        for i in range(1,len(nodes)):
+            polytomies[size[i]]=polytomies.get(size[i],0)+1
+
+        def survivor(i): ## closest surviving ancestor of node i, with path compression
+            j=i
+            while collapsed[j]:
+                j=up[j]
+            while up[i]!=j and collapsed[i]:
+                up[i],i=j,up[i]
+            return j
+
+        results={}
+        s=0
+        for threshold in sorted(set(thresholds)):
+            while s<len(support) and support[s][0]<=threshold: ## collapse every node with support at or below threshold
+                i=support[s][1]
+                a=survivor(up[i])
+                for j in [a,i]:
+                    if j!=0:
+                        polytomies[size[j]]-=1
+                size[a]+=size[i]-1 ## children of collapsed node move up to its surviving ancestor
+                if a!=0:
+                    polytomies[size[a]]=polytomies.get(size[a],0)+1
+                collapsed[i]=True
+                s+=1
+            sizes={n:c for n,c in polytomies.items() if c>0}
+            if size[0]>1: ## root has become a polytomy itself
+                sizes[size[0]]=sizes.get(size[0],0)+1
+            results[threshold]={'threshold':threshold,'resolved':len(self.nodes)-s,'collapsed':s,'polytomies':dict(sorted(sizes.items()))}
+
+        out=[]
+        for threshold in thresholds:
+            result=dict(results[threshold])
+            if trees==True:
+                result['tree']=self._collapse_at(trait,threshold)
+            out.append(result)
+        return out
+
+    def _collapse_at(self,trait,threshold):
+        """ Function building a copy of the tree with nodes whose support is at or below threshold collapsed. """
+        def support(x):
+            try:
+                return float(x)<=threshold
+            except (TypeError,ValueError):
+                return False
+        return lambda:self.collapseBranches(trait=trait,f=support)
+
     def toString(self,traits=[],numName=False,verbose=False,nexus=False):
         """ Output the topology of the tree with branch lengths to string """
-        cur_node=self.root
-        seen=[]
-        tree_string=[]
-        root=False
-
-        while root==False:
-            if cur_node.branchType=='node':
+        buf=io.StringIO()
+        self.writeNewick(buf,traits=traits,numName=numName,verbose=verbose,end='')
+        if nexus==True:
+            return '#NEXUS\nBegin trees;\ntree TREE1 = [&R] %s;\nEnd;'%(buf.getvalue())
+        else:
+            return buf.getvalue()+';' ## the coup de grace
+
+    def writeNewick(self,handle,traits=[],numName=False,translate=None,verbose=False,end=';'):
+        """ Stream the topology of the tree with branch lengths and selected traits to a file handle or buffer.
+        Visits every branch once and writes in chunks, so the full string is never held in memory.
+        translate is an optional dictionary of tip name to the token written in its place (e.g. a NEXUS translate table). """
+        chunk=[] ## pending output, flushed to the handle every few thousand pieces
+        stack=[self.root.children[0]] ## the root itself is never written
+        while stack:
+            k=stack.pop()
+            if isinstance(k,str): ## commas between children
+                chunk.append(k)
+            elif isinstance(k,tuple): ## all children of the node written, close it
+                k=k[0]
+                chunk.append(')%s:%8f'%(format_comment(k.traits,traits),k.length)) ## end of node, add branch length with annotations
+            elif k.branchType=='node':
                 if verbose==True:
-                    print('Encountered node %s'%(cur_node.index))
-                ## if all children have been seen and not at root
-                while sum([1 if x.index in seen else 0 for x in cur_node.children])==len(cur_node.children) and cur_node.index!='Root':
-                    if cur_node.parent.index=='Root':
-                        root=True
-                        break
-                    else:
-                        comment=[]
-                        if len(traits)>0:
-                            for tr in traits:
-                                if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-                        if len(comment)>0:
-                            comment=','.join(comment)
-                            comment='[&'+comment+']'
-                            tree_string.append(')%s:%8f'%(comment,cur_node.length)) ## end of node, add branch length with annotations
-                        else:
-                            tree_string.append('):%8f'%(cur_node.length)) ## end of node, add branch length
-                        cur_node=cur_node.parent ## go back
-
-                seen.append(cur_node.index)
-                last_seen=[1 if x.index in seen else 0 for x in cur_node.children]
-
-                if 0 in last_seen: ## there's unvisited children
-                    idx_to_visit=last_seen.index(0)
-                    if idx_to_visit>0: ## first child definitely seen, so visiting the second child at the very least
-                        tree_string.append(',') ## add comma to indicate bifurcation
-                    cur_node=cur_node.children[idx_to_visit]
-
-                    if cur_node.branchType=='node':
-                        tree_string.append('(') ## dealing with new node, add (
-                    else:
-                        comment=[]
-                        if len(traits)>0: ## if a designated trait list exists
-                            for tr in traits: ## iterate over traits
-                                if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-
-                        if numName==False: ## if real names wanted
-                            assert cur_node.name!=None,'Tip does not have converted names' ## assert they have been converted
-                            treeName=cur_node.name ## designate real name
-                        elif numName==True: ## if number names wanted
-                            treeName=cur_node.numName ## designated numName
-
-                        if len(comment)>0:
-                            comment=','.join(comment) ## join up traits with commas
-                            comment='[&'+comment+']' ## add starting and end bracket
-                            tree_string.append('\'%s\'%s:%8f'%(treeName,comment,cur_node.length)) ## dealing with tip, write out name, add branch length with annotation
-                        else:
-                            tree_string.append('\'%s\':%8f'%(treeName,cur_node.length)) ## dealing with tip, write out name, add branch length
-
-                else: ## all children seen, clade's end
-                    comment=[]
-                    if len(traits)>0:
-                        for tr in traits:
-                            if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-                    if len(comment)>0:
-                        comment=','.join(comment)
-                        comment='[&'+comment+']'
-                        tree_string.append(')%s:%8f'%(comment,cur_node.length))
-                    else:
-                        tree_string.append('):%8f'%(cur_node.length))
-                    cur_node=cur_node.parent
-
-            elif cur_node.branchType=='leaf':
+                    print('Encountered node %s'%(k.index))
+                chunk.append('(') ## dealing with new node, add (
+                stack.append((k,))
+                for j in range(len(k.children)-1,-1,-1): ## children go on the stack in reverse so they come off in order
+                    stack.append(k.children[j])
+                    if j>0:
+                        stack.append(',') ## add comma to indicate bifurcation
+            else:
                 if verbose==True:
-                    print('Encountered leaf %s'%(cur_node.index))
-                seen.append(cur_node.index)
-                if cur_node.parent.index=='Root':
-                    root=True
-                    break
+                    print('Encountered leaf %s'%(k.index))
+                if numName==False: ## if real names wanted
+                    assert k.name!=None,'Tip does not have converted names' ## assert they have been converted
+                    treeName=k.name ## designate real name
+                else: ## if number names wanted
+                    treeName=k.numName ## designated numName
+                if translate is None:
+                    chunk.append('\'%s\'%s:%8f'%(treeName,format_comment(k.traits,traits),k.length)) ## dealing with tip, write out name, add branch length with annotation
                 else:
-                    cur_node=cur_node.parent
+                    chunk.append('%s%s:%8f'%(translate[treeName],format_comment(k.traits,traits),k.length))
 
-        if nexus==True:
-            return '#NEXUS\nBegin trees;\ntree TREE1 = [&R] %s;\nEnd;'%(''.join(tree_string))
-        else:
-            return ''.join(tree_string)+';' ## the coup de grace
+            if len(chunk)>=4096:
+                handle.write(''.join(chunk))
+                chunk=[]
+        chunk.append(end)
+        handle.write(''.join(chunk))
 
     def allTMRCAs(self):
-        tip_names=[k.numName for k in self.Objects if isinstance(k,leaf)]
-        tmrcaMatrix={x:{y:None for y in tip_names} for x in tip_names} ## pairwise matrix of tips
+        """ Nested dictionary of the absolute time of the most recent common ancestor of every pair of tips, keyed by numName.
+        Built from tmrcaMatrix(), which is better suited to large trees. """
+        matrix,names=self.tmrcaMatrix(tips=[k.numName for k in self.Objects if isinstance(k,leaf_base)],numName=True)
+        return {x:{y:(None if v!=v else v) for y,v in zip(names,row)} for x,row in zip(names,matrix.tolist())}
+
+    def _tip_selection(self,tips=None,numName=False):
+        """ Names (numNames if numName is True) of the given tips (all by default) in tip order,
+        and the number of them before each position in tip order. """
+        if numName==True:
+            label=lambda k:k.numName
+        else:
+            label=lambda k:self.tipMap[k.numName] if self.tipMap!=None else k.name
 
-        for k in self.Objects:
-            if isinstance(k,node):
-                all_children=k.leaves ## fetch all descendant tips of node
-                #print all_children
-                for x in range(0,len(all_children)-1): ## for all pairwise comparisons of tips
-                    for y in range(x+1,len(all_children)):
-                        tipA=all_children[x]
-                        tipB=all_children[y]
-                        if tmrcaMatrix[tipA][tipB]==None or tmrcaMatrix[tipA][tipB]<=k.absoluteTime: ## if node's time is more recent than previous entry - set new TMRCA value for pair of tips
-                            tmrcaMatrix[tipA][tipB]=k.absoluteTime
-                            tmrcaMatrix[tipB][tipA]=k.absoluteTime
-        return tmrcaMatrix
+        if tips==None:
+            selected=[True]*len(self.tipOrder)
+        else:
+            wanted=set(tips)
+            selected=[label(k) in wanted for k in self.tipOrder]
+            found=set([label(k) for k,s in zip(self.tipOrder,selected) if s])
+            assert len(found)==len(wanted),'Not all specified tips are in tree: %s'%(list(wanted-found))
+        names=[label(k) for k,s in zip(self.tipOrder,selected) if s]
+        rank=[0]+np.cumsum(selected,dtype=np.int64).tolist()
+        return names,rank
+
+    def _tip_blocks(self,rank):
+        """ Pairs of tips grouped by their most recent common ancestor. Tips of the children of a node are consecutive
+        in tip order, so for every node and child the pairs of that child's tips (rows a to b) with the tips of all
+        later children (columns c to end) are one block. Yields (node,a,b,c,end), rows and columns counted with rank. """
+        for k in self._preorder(self.root):
+            if k.branchType=='node' and len(k.children)>1:
+                bounds=[] ## rows of the tips of each child
+                for ch in k.children:
+                    last=ch.firstTip+1 if ch.branchType=='leaf' else ch.lastTip
+                    bounds.append((rank[ch.firstTip],rank[last]))
+                end=bounds[-1][1]
+                for (a,b),(c,d) in zip(bounds[:-1],bounds[1:]):
+                    if b>a and end>c:
+                        yield k,a,b,c,end
+
+    def tmrcaMatrix(self,tips=None,numName=False,dtype=np.float64,memmap=None):
+        """ Absolute times of the most recent common ancestors of all pairs of tips as a NumPy matrix (NaN on the diagonal).
+        Returns the matrix and the list of tip names (numNames if numName is True) labelling its rows and columns,
+        which follow the tip order of the tree.
+        tips: names of the tips to restrict the matrix to, by default all tips.
+        dtype: e.g. np.float32 to halve the size of the matrix.
+        memmap: path of a .npy file to write the matrix to, for matrices too large for memory (opened with np.lib.format.open_memmap).
+        Every node fills whole blocks of the matrix (see _tip_blocks()) and every entry is written once. """
+        self.refresh(layout=False)
+        names,rank=self._tip_selection(tips,numName)
+        n=len(names)
+
+        if memmap==None:
+            matrix=np.empty((n,n),dtype=dtype)
+        else:
+            matrix=np.lib.format.open_memmap(memmap,mode='w+',dtype=dtype,shape=(n,n))
+        matrix[np.arange(n),np.arange(n)]=np.nan
+
+        for k,a,b,c,end in self._tip_blocks(rank):
+            t=np.nan if k.absoluteTime==None else k.absoluteTime
+            matrix[a:b,c:end]=t
+            matrix[c:end,a:b]=t
+        if memmap!=None:
+            matrix.flush()
+        return matrix,names
+
+    def iterDistanceMatrix(self,tips=None,numName=False,chunk=2048,dtype=np.float64):
+        """ Patristic (tip to tip) distances, height(i)+height(j)-2*height(most recent common ancestor), a few rows at a time.
+        Returns the list of tip names (numNames if numName is True) labelling rows and columns, in the tip order of the tree,
+        and a generator of (first row, block of chunk rows by all columns). Only one block is held in memory at a time. """
+        self.refresh(layout=False)
+        names,rank=self._tip_selection(tips,numName)
+        n=len(names)
+        height=np.array([k.height for k,r0,r1 in zip(self.tipOrder,rank[:-1],rank[1:]) if r1>r0],dtype=np.float64)
+        blocks=np.array([(a,b,c,end,k.height) for k,a,b,c,end in self._tip_blocks(rank)],dtype=np.float64).reshape(-1,5)
+        a,b,c,end=[blocks[:,i].astype(np.int64) for i in range(4)]
+        ancestor=blocks[:,4]
+
+        def rows():
+            for start in range(0,n,chunk):
+                stop=min(start+chunk,n)
+                out=np.zeros((stop-start,n),dtype=dtype)
+                for i in np.flatnonzero((a<stop)&(b>start)).tolist(): ## blocks with rows in this chunk
+                    r0,r1=max(a[i],start),min(b[i],stop)
+                    out[r0-start:r1-start,c[i]:end[i]]=height[r0:r1,None]+height[None,c[i]:end[i]]-2*ancestor[i]
+                for i in np.flatnonzero((c<stop)&(end>start)).tolist(): ## mirror images of blocks with columns in this chunk
+                    r0,r1=max(c[i],start),min(end[i],stop)
+                    out[r0-start:r1-start,a[i]:b[i]]=height[r0:r1,None]+height[None,a[i]:b[i]]-2*ancestor[i]
+                yield start,out
+        return names,rows()
+
+    def distanceMatrix(self,tips=None,numName=False,dtype=np.float64,condensed=False,memmap=None,chunk=2048):
+        """ Patristic (tip to tip) distance matrix from branch heights, computed in blocks of rows (see iterDistanceMatrix()).
+        Returns the matrix and the list of tip names (numNames if numName is True) labelling its rows and columns, in tip order.
+        tips: names of the tips to restrict the matrix to, by default all tips.
+        condensed: return the upper triangle as a flat array, row by row (the layout of scipy.spatial.distance.pdist).
+        memmap: path of a .npy file to write the output to, for matrices too large for memory. """
+        names,blocks=self.iterDistanceMatrix(tips=tips,numName=numName,chunk=chunk,dtype=dtype)
+        n=len(names)
+        shape=(n*(n-1)//2,) if condensed==True else (n,n)
+        if memmap==None:
+            out=np.empty(shape,dtype=dtype)
+        else:
+            out=np.lib.format.open_memmap(memmap,mode='w+',dtype=dtype,shape=shape)
+
+        for start,block in blocks:
+            if condensed==True:
+                for r in range(len(block)):
+                    i=start+r
+                    offset=i*n-i*(i+1)//2 ## position of pair (i,i+1)
+                    out[offset:offset+n-i-1]=block[r,i+1:]
+            else:
+                out[start:start+len(block)]=block
+        if memmap!=None:
+            out.flush()
+        return out,names
+
+    def toFlat(self):
+        """ Flatten the tree into a dictionary of plain per-branch lists in preorder (root first).
+        Unlike the object graph it pickles compactly and without recursion. Rebuild with tree_from_flat(). """
+        preorder=[]
+        stack=[self.root]
+        while stack: ## iterative preorder traversal, children in their current order
+            k=stack.pop()
+            assert not isinstance(k,clade_base),'Cannot flatten trees with collapsed clades'
+            preorder.append(k)
+            if k.branchType=='node':
+                stack.extend(reversed(k.children))
+        position={id(k):i for i,k in enumerate(preorder)}
+
+        flat={'branchType':[k.branchType for k in preorder],
+              'parent':[-1]+[position[id(k.parent)] for k in preorder[1:]],
+              'index':[k.index for k in preorder],
+              'length':[k.length for k in preorder],
+              'height':[k.height for k in preorder],
+              'absoluteTime':[k.absoluteTime for k in preorder],
+              'x':[k.x for k in preorder],
+              'y':[k.y for k in preorder],
+              'childHeight':[getattr(k,'childHeight',None) for k in preorder],
+              'name':[getattr(k,'name',None) for k in preorder],
+              'numName':[getattr(k,'numName',None) for k in preorder],
+              'traits':[copy.copy(k.traits) for k in preorder], ## copies, so the flattened tree does not share them with this one
+              'objects':[position[id(k)] for k in self.Objects], ## preserves the order of tree.Objects
+              'tipMap':self.tipMap,
+              'treeHeight':self.treeHeight,
+              'ySpan':self.ySpan,
+              'compact':self.compact}
+        return flat
+
+    def toArrays(self):
+        """ Convert to an array_tree, the struct-of-arrays representation of this tree. """
+        return array_tree(self.toFlat())
 
     def reduceTree(self,keep):
         """
         Reduce the tree to just those tracking a small number of tips.
         Returns a new baltic tree object.
         """
-        assert len(keep)>0,"No tips given to reduce the tree to."
-        assert len([k for k in keep if k.branchType!='leaf'])==0, "Embedding contains %d non-leaf branches."%(len([k for k in keep if k.branchType!='leaf']))
-        embedding=[]
-        reduced_tree=copy.deepcopy(self) ## new tree object
-        for k in reduced_tree.Objects: ## deep copy branches from current tree
-            if k.index in [q.index for q in keep]: ## if branch is designated as one to keep
-                cur_b=k
-                while cur_b: ## descend to root
-                    embedding.append(cur_b) ## keep track of the path to root
+        return self.reduceTrees([keep])[0]
+
+    def reduceTrees(self,keeps,view=False):
+        """
+        Reduce the tree to each of a list of sets of tips (tips are matched by index, so they may come from a copy of the tree).
+        The branches on the paths from each set's tips to the root are marked by walking up until a marked branch is reached,
+        so each reduction only touches (and copies) the branches it keeps. Single-child nodes are kept, call singleType() to remove them.
+        Returns a list of new baltic tree objects, or of subtree_view objects sharing branches with this tree if view is True.
+        """
+        self.refresh(layout=False)
+        tips={k.index:k for k in self.Objects if k.branchType=='leaf'}
+        preorder=self._preorder(self.root)
+        position={id(k):i for i,k in enumerate(preorder)}
+
+        reduced=[]
+        for keep in keeps:
+            assert len(keep)>0,"No tips given to reduce the tree to."
+            assert len([k for k in keep if k.branchType!='leaf'])==0, "Embedding contains %d non-leaf branches."%(len([k for k in keep if k.branchType!='leaf']))
+            embedding={id(self.root):self.root}
+            for q in keep:
+                cur_b=tips[q.index]
+                while id(cur_b) not in embedding: ## ascend until reaching the path of a previous tip
+                    embedding[id(cur_b)]=cur_b
                     cur_b=cur_b.parent
-                embedding=list(set(embedding)) ## prune down to only unique branches
+            branches=sorted(embedding.values(),key=lambda x:position[id(x)])[1:] ## embedding in preorder, without the root
+            if view==True:
+                reduced.append(subtree_view(self,branches,prune=True))
+                continue
+
+            local_tree=tree(compact=self.compact) ## new tree object
+            local_tree.root.absoluteTime=self.root.absoluteTime
+            local_tree.tipMap=None if self.tipMap==None else dict(self.tipMap)
+            copies={id(self.root):local_tree.root}
+            for k in branches: ## copy kept branches, only keeping children that are present in lineage traceback
+                c=copy.copy(k)
+                c.traits=copy.deepcopy(k.traits)
+                c.parent=copies[id(k.parent)]
+                c.parent.children.append(c)
+                if k.branchType=='node':
+                    c.children=[]
+                copies[id(k)]=c
+            local_tree.Objects=sorted([copies[id(k)] for k in branches],key=lambda x:x.height) ## assign branches that are kept to new tree's Objects
+            local_tree.traverse_tree() ## traverse
+            local_tree.sortBranches() ## sort
+            reduced.append(local_tree)
+        return reduced
+
+class subtree_view: ## part of a tree, sharing its branches
+    """ Subtree of another tree returned by tree.subtree(view=True), which shares the branch objects of that tree instead of copying them.
+    Its own root (a fresh node above the first branch), order of children, heights (measured from its root),
+    descendant tip counts and layout are kept in the view, so sorting and drawing it leaves the shared branches untouched:
+    heights, x and y coordinates are in self.heights, self.xs and self.ys (NumPy arrays in the order of self.Objects)
+    and the children of a branch in the view's order are given by children().
+    Branches listed without their descendants bring all of those along, as copying them used to.
+    commonAncestor() and commonAncestors() are answered on the view itself. Other tree methods (e.g. collapseSubtree())
+    are not available on a view, materialize() returns an ordinary tree of copies of the branches to call them on,
+    so that edits never reach the tree the view came from. Changes made directly to the shared branches (e.g. to their traits) show up in both. """
+    def __init__(self,source,branches,prune=False):
+        self.source=source
+        self.compact=source.compact
+        self.tipMap=source.tipMap
+        self.root=compact_node() if source.compact else node()
+        self.root.index='Root'
+        self.root.length=0.0
+        self.root.height=0.0
+        top=branches[0]
+        self.root.children=[top]
+        self.root.absoluteTime=None if top.absoluteTime==None else top.absoluteTime-top.length
+
+        members=set(map(id,branches))
+        if not prune: ## descendants that were not listed come along with their ancestors
+            extra=[]
+            for k in branches:
+                for ch in k.children if k.branchType=='node' else []:
+                    if id(ch) not in members:
+                        for w in source._preorder(ch):
+                            if id(w) not in members:
+                                members.add(id(w))
+                                extra.append(w)
+            branches=branches+extra
+        self._children={id(self.root):[top]}
+        for k in branches:
+            if k.branchType=='node':
+                self._children[id(k)]=[ch for ch in k.children if id(ch) in members]
+        if prune: ## remove nodes left without children, and then their parents if they end up without any
+            for k in reversed(self._preorder()):
+                if k.branchType=='node' and len(self._children[id(k)])==0 and k!=self.root:
+                    members.discard(id(k))
+                    parent=self.root if k==top else k.parent
+                    self._children[id(parent)].remove(k)
+        self.Objects=[k for k in branches if id(k) in members]
+        self.sortBranches()
 
-        reduced_tree.Objects=sorted([k for k in embedding if k.index!='Root'],key=lambda x:x.height) ## assign branches that are kept to new tree's Objects
-        reduced_tree.root=[k for k in embedding if k.index=='Root'][0]
-        # reduced_tree.tipMap=self.tipMap
+    def children(self,k):
+        """ Children of branch k in this view, in the view's order. """
+        return self._children.get(id(k),[])
+
+    def _preorder(self):
+        preorder=[]
+        stack=[self.root]
+        while stack:
+            k=stack.pop()
+            preorder.append(k)
+            stack.extend(reversed(self._children.get(id(k),[])))
+        return preorder
+
+    def traverse_tree(self,include_all=False):
+        """ Branches of the view in preorder (only tips unless include_all is True). Sets heights, numbers of descendant tips and the tree height of the view. """
+        preorder=self._preorder()
+        height={id(self.root):0.0}
+        numChildren={}
+        for k in preorder[1:]:
+            height[id(k)]=height[id(k.parent) if k!=self.root.children[0] else id(self.root)]+float(k.length)
+        for k in reversed(preorder):
+            if k.branchType=='node':
+                numChildren[id(k)]=sum([1 if ch.branchType=='leaf' else numChildren[id(ch)] for ch in self._children[id(k)]])
+        self._height=height
+        self._numChildren=numChildren
+        self.heights=np.array([height[id(k)] for k in self.Objects],dtype=np.float64)
+        self.treeHeight=float(max([0.0]+[height[id(k)] for k in preorder if k.branchType=='leaf']))
+        self.leaves=[k for k in self.Objects if k.branchType=='leaf']
+        self.nodes=[k for k in self.Objects if k.branchType=='node']
+        if include_all==True:
+            return preorder
+        return [k for k in preorder if k.branchType=='leaf']
 
-        for k in reduced_tree.Objects: ## iterate through reduced tree
-            if k.branchType=='node': ## node
-                ## only keep children that are present in lineage traceback
-                k.children = [c for c in k.children if c in embedding]
+    def sortBranches(self,descending=True):
+        """ Sort children of each node of the view (nodes by number of descendant tips, then branch length, tips by branch length) and draw it. """
+        modifier=-1 if descending==True else 1
+        self.traverse_tree()
+        for k in self.Objects:
+            if k.branchType=='node':
+                children=self._children[id(k)]
+                nodes=sorted([x for x in children if x.branchType=='node'],key=lambda q:(-self._numChildren[id(q)]*modifier,q.length*modifier))
+                leaves=sorted([x for x in children if x.branchType=='leaf'],key=lambda q:q.length*modifier)
+                self._children[id(k)]=nodes+leaves if modifier==1 else leaves+nodes
+        self.drawTree()
+
+    def drawTree(self):
+        """ Rectangular layout of the view like tree.drawTree(), kept in self.xs and self.ys. """
+        preorder=self._preorder() ## heights are set by traverse_tree() when sorting
+        order=[k for k in preorder if k.branchType=='leaf']
+        skips=[1 if isinstance(k,leaf_base) else k.width+1 for k in order]
+        y={}
+        total=0
+        for k,skip in zip(reversed(order),reversed(skips)):
+            total+=skip
+            y[id(k)]=total-skip/2.0 if isinstance(k,clade_base) else total
+        for k in reversed(preorder[1:]):
+            if k.branchType=='node':
+                y[id(k)]=sum([y[id(q)] for q in self._children[id(k)]])/float(len(self._children[id(k)]))
+        self.xs=self.heights.copy()
+        self.ys=np.array([y[id(k)] for k in self.Objects],dtype=np.float64)
+        self.ySpan=sum(skips)
+
+    def materialize(self):
+        """ Ordinary tree of copies of the branches of this view, in the view's order. """
+        local_tree=tree(compact=self.compact)
+        copies={id(self.root):local_tree.root}
+        local_tree.root.absoluteTime=self.root.absoluteTime
+        for k in self._preorder()[1:]:
+            c=copy.copy(k)
+            c.traits=copy.deepcopy(k.traits)
+            c.parent=copies[id(k.parent) if k!=self.root.children[0] else id(self.root)]
+            c.parent.children.append(c)
+            if k.branchType=='node':
+                c.children=[]
+            copies[id(k)]=c ## collapsed clades keep referring to the original collapsed branches
+        local_tree.Objects=[copies[id(k)] for k in self.Objects]
+        local_tree.sortBranches() ## sort branches, draw small tree
+        return local_tree
 
-        reduced_tree.traverse_tree() ## traverse
-        reduced_tree.sortBranches() ## sort
+    def commonAncestor(self,descendants,numName=False):
+        """ Most recent node of the view ancestral to all given tips: names (numNames if numName is True) or tip branches of the view. """
+        return self.commonAncestors([descendants],numName=numName)[0]
+
+    def commonAncestors(self,groups,numName=False):
+        """ Most recent common ancestor node in the view of every group of tips (see commonAncestor()).
+        Walks up from the first tip of each group in the view's preorder until reaching a node whose descendants include the last. """
+        preorder=self._preorder()
+        position={id(k):i for i,k in enumerate(preorder)}
+        last=list(range(len(preorder))) ## last preorder position among each branch's descendants
+        for i in range(len(preorder)-1,0,-1):
+            j=position[id(self._parent(preorder[i]))]
+            last[j]=max(last[j],last[i])
+        branches={id(k):k for k in self.leaves}
+        labels={(k.numName if numName==True else (self.tipMap[k.numName] if self.tipMap!=None else k.name)):k for k in self.leaves}
+
+        ancestors=[]
+        for group in groups:
+            tips=[branches[id(w)] if id(w) in branches else labels.get(w) for w in group]
+            missing=[w for w,k in zip(group,tips) if k==None]
+            assert len(missing)==0,'Not all specified descendants are in tree: %s'%(missing)
+            assert len(tips)>0,'No descendants given'
+            first=min([position[id(k)] for k in tips])
+            end=max([position[id(k)] for k in tips])
+            ancestor=self._parent(preorder[first])
+            while last[position[id(ancestor)]]<end:
+                ancestor=self._parent(ancestor)
+            ancestors.append(ancestor)
+        return ancestors
+
+    def _parent(self,k):
+        return self.root if k==self.root.children[0] else k.parent
+
+    def __getattr__(self,name):
+        if not name.startswith('__') and hasattr(tree,name):
+            raise AttributeError('%s() is not available on a subtree view, call materialize() to get a tree of copies first'%(name))
+        raise AttributeError(name)
+
+class lca_index: ## most recent common ancestor queries in constant time
+    """ Index of a tree for finding most recent common ancestors (LCA) of tips.
+    Tips of any group have the same common ancestor as the first and the last of them in the tree's tip order, and the
+    common ancestor of two branches is the parent of the shallowest branch between them in preorder (excluding the first one).
+    The shallowest branch in a range of preorder is found with a sparse table of minima, so after building it in
+    O(n log n) every pair is answered in constant time and a group of k tips in O(k). """
+    def __init__(self,tree):
+        preorder=tree._preorder(tree.root)
+        position={id(k):i for i,k in enumerate(preorder)}
+        depth=[0]*len(preorder)
+        for i,k in enumerate(preorder[1:],start=1): ## number of branches between each branch and the root
+            depth[i]=depth[position[id(k.parent)]]+1
+        self.preorder=preorder
+        self.depth=np.array(depth,dtype=np.int32)
+        self.tipPositions=np.array([position[id(k)] for k in tree.tipOrder],dtype=np.int64) ## preorder position of every tip in tip order
+        self.tipMap=tree.tipMap
+        self.tipOrder=tree.tipOrder
+        self.labels={} ## tip name (or numName) to positions in tip order, for each kind of name
+
+        n=len(preorder)
+        table=[np.arange(n,dtype=np.int32)] ## table[j][i] is the shallowest branch among preorder positions i to i+2**j-1
+        span=1
+        while 2*span<=n:
+            previous=table[-1]
+            left=previous[:n-2*span+1]
+            right=previous[span:n-span+1]
+            table.append(np.where(self.depth[left]<=self.depth[right],left,right))
+            span*=2
+        self.table=table
+
+    def _label(self,k,numName):
+        if numName==True:
+            return k.numName
+        return self.tipMap[k.numName] if self.tipMap!=None else k.name
+
+    def positions(self,names,numName=False):
+        """ Positions in tip order of all tips with the given names. """
+        if numName not in self.labels:
+            labels={}
+            for i,k in enumerate(self.tipOrder):
+                labels.setdefault(self._label(k,numName),[]).append(i)
+            self.labels[numName]=labels
+        labels=self.labels[numName]
+        missing=[name for name in names if name not in labels]
+        assert len(missing)==0,'Not all specified descendants are in tree: %s'%(missing)
+        return [i for name in names for i in labels[name]]
+
+    def query(self,first,last):
+        """ Most recent common ancestors of pairs of tips, given by arrays of their positions in tip order (first<=last).
+        Returns preorder positions. The common ancestor of a tip with itself is its parent. """
+        a=self.tipPositions[np.asarray(first,dtype=np.int64)]+1
+        b=self.tipPositions[np.asarray(last,dtype=np.int64)]
+        same=a>b
+        a[same]=b[same] ## a tip with itself - the shallowest branch of the range is the tip
+        level=np.floor(np.log2(b-a+1)).astype(np.int64)
+        result=np.empty(len(a),dtype=np.int64)
+        for j in np.unique(level).tolist():
+            rows=level==j
+            left=self.table[j][a[rows]]
+            right=self.table[j][b[rows]-2**j+1]
+            result[rows]=np.where(self.depth[left]<=self.depth[right],left,right)
+        return result
+
+    def commonAncestors(self,groups,numName=False):
+        """ Most recent common ancestor node of every group of tip names. """
+        first=[]
+        last=[]
+        for group in groups:
+            positions=self.positions(group,numName)
+            assert len(positions)>0,'No descendants given'
+            first.append(min(positions))
+            last.append(max(positions))
+        shallowest=self.query(first,last).tolist()
+        return [self.preorder[i].parent for i in shallowest]
+
+def _float_column(column):
+    """ Property exposing one float array of an array_tree as an attribute of a branch view, NaN standing in for None. """
+    def getter(self):
+        value=getattr(self.tree,column)[self.id]
+        return None if value!=value else float(value)
+    def setter(self,value):
+        getattr(self.tree,column)[self.id]=np.nan if value is None else value
+    return property(getter,setter)
+
+def _list_column(column):
+    """ Property exposing one per-branch list of an array_tree as an attribute of a branch view. """
+    def getter(self):
+        return getattr(self.tree,column)[self.id]
+    def setter(self,value):
+        getattr(self.tree,column)[self.id]=value
+    return property(getter,setter)
+
+class branch_view: ## lightweight stand-in for a node or leaf of an array_tree
+    """ A branch of an array_tree. Holds nothing but the tree and the branch ID, every attribute is read from (and written to) the tree's arrays. """
+    __slots__=('tree','id')
+    def __init__(self,tree,i):
+        self.tree=tree
+        self.id=i
+
+    def __eq__(self,other):
+        return isinstance(other,branch_view) and other.tree is self.tree and other.id==self.id
+
+    def __hash__(self):
+        return hash((id(self.tree),self.id))
+
+    def __repr__(self):
+        return '<%s %d of %s>'%(self.__class__.__name__,self.id,self.tree.__class__.__name__)
+
+    length=_float_column('length')
+    height=_float_column('height')
+    absoluteTime=_float_column('absoluteTime')
+    x=_float_column('x')
+    y=_float_column('y')
+    index=_list_column('index')
+
+    @property
+    def parent(self):
+        p=self.tree.parent[self.id]
+        return None if p<0 else self.tree.view(p)
+
+    @property
+    def traits(self):
+        traits=self.tree.traits[self.id]
+        if traits is None: ## branches without annotations share nothing until written to
+            traits={}
+            self.tree.traits[self.id]=traits
+        return traits
+
+    @traits.setter
+    def traits(self,value):
+        self.tree.traits[self.id]=value
+
+class node_view(branch_view): ## node of an array_tree
+    __slots__=()
+    branchType='node'
+
+    @property
+    def children(self):
+        return [self.tree.view(c) for c in self.tree.children(self.id)]
+
+    @property
+    def leaves(self):
+        """ sorted list of the names of all descendant tips """
+        return sorted(self.tree.numName[t] for t in self.tree.tipOrder[self.tree.firstTip[self.id]:self.tree.lastTip[self.id]])
+
+    @property
+    def numChildren(self):
+        return int(self.tree.lastTip[self.id]-self.tree.firstTip[self.id])
+
+    childHeight=_float_column('childHeight')
+
+class leaf_view(branch_view): ## leaf of an array_tree
+    __slots__=()
+    branchType='leaf'
+    name=_list_column('name')
+    numName=_list_column('numName')
+
+class branch_list: ## read-only sequence of branch views
+    """ Sequence of branch IDs of an array_tree that hands out views on access, so no per-branch objects are kept around. """
+    def __init__(self,tree,ids):
+        self.tree=tree
+        self.ids=ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return branch_list(self.tree,self.ids[i])
+        return self.tree.view(self.ids[i])
+
+    def __iter__(self):
+        view=self.tree.view
+        for i in self.ids.tolist():
+            yield view(i)
+
+class array_tree: ## struct-of-arrays tree class
+    """ Alternative, array-backed representation of a tree.
+    Every branch gets a stable integer ID (its position in preorder when the array_tree was built, the root is 0).
+    Topology (parent IDs, CSR child offsets) and the numeric attributes (length, height, absoluteTime, x, y)
+    live in contiguous NumPy arrays, names and traits in plain per-branch lists (traits are None until written to).
+    Objects, nodes, leaves and root are lightweight views that behave like node and leaf objects for reading
+    (.parent, .children, .height, .leaves, ...) and for writing attributes, while bulk operations work on the arrays directly.
+    Topology is fixed - edit a tree object and convert again (tree.toArrays(), array_tree.toTree()). """
+    def __init__(self,flat):
+        n=len(flat['branchType'])
+        self.parent=np.array(flat['parent'],dtype=np.int64)
+        self.isLeaf=np.array([b=='leaf' for b in flat['branchType']],dtype=bool)
+        counts=np.bincount(self.parent[1:],minlength=n)
+        self.childOffsets=np.zeros(n+1,dtype=np.int64)
+        np.cumsum(counts,out=self.childOffsets[1:])
+        self.childIds=np.argsort(self.parent[1:],kind='stable')+1 ## preorder keeps children in order, a stable sort groups them by parent
+
+        for column in ['length','height','absoluteTime','x','y','childHeight']:
+            setattr(self,column,np.array([np.nan if v is None else v for v in flat[column]],dtype=np.float64))
+        self.index=list(flat['index'])
+        self.name=list(flat['name'])
+        self.numName=list(flat['numName'])
+        self.traits=[copy.copy(t) if len(t)>0 else None for t in flat['traits']]
+        self.objectOrder=np.array(flat['objects'],dtype=np.int64) ## order of tree.Objects in the source tree
+        self.tipMap=flat['tipMap']
+        self.treeHeight=flat['treeHeight']
+        self.ySpan=flat['ySpan']
+        self._index_tips()
+
+    def view(self,i):
+        """ Node or leaf view of the branch with ID i. """
+        return leaf_view(self,i) if self.isLeaf[i] else node_view(self,i)
+
+    def children(self,i):
+        """ Array of the IDs of the children of branch i, in order. """
+        return self.childIds[self.childOffsets[i]:self.childOffsets[i+1]]
+
+    @property
+    def root(self):
+        return node_view(self,0)
+
+    @property
+    def Objects(self):
+        return branch_list(self,self.objectOrder)
+
+    @property
+    def nodes(self):
+        return branch_list(self,self.objectOrder[~self.isLeaf[self.objectOrder]])
+
+    @property
+    def leaves(self):
+        return branch_list(self,self.objectOrder[self.isLeaf[self.objectOrder]])
+
+    def _preorder(self):
+        """ List of branch IDs in preorder, following the current order of children. """
+        offsets=self.childOffsets.tolist()
+        childIds=self.childIds.tolist()
+        order=[]
+        stack=[0]
+        while stack:
+            i=stack.pop()
+            order.append(i)
+            stack.extend(reversed(childIds[offsets[i]:offsets[i+1]]))
+        return order
+
+    def _index_tips(self):
+        """ Tip order (tips in preorder) and, for every branch, the range [firstTip, lastTip) of its descendant tips within it. """
+        order=self._preorder()
+        isLeaf=self.isLeaf.tolist()
+        parent=self.parent.tolist()
+        n=len(order)
+        first=[0]*n
+        last=[0]*n
+        tips=[]
+        for i in order: ## tips are numbered in the order they are met
+            first[i]=len(tips)
+            if isLeaf[i]:
+                tips.append(i)
+        for i in reversed(order): ## every subtree ends where its last descendant tip does
+            if isLeaf[i]:
+                last[i]=first[i]+1
+            if i>0 and last[i]>last[parent[i]]:
+                last[parent[i]]=last[i]
+        self.preorder=np.array(order,dtype=np.int64)
+        self.tipOrder=np.array(tips,dtype=np.int64)
+        self.firstTip=np.array(first,dtype=np.int64)
+        self.lastTip=np.array(last,dtype=np.int64)
+
+    def traverse_tree(self):
+        """ Recompute heights (root at 0), the youngest descendant tip height of every node and the tree height. """
+        length=np.nan_to_num(self.length).tolist()
+        parent=self.parent.tolist()
+        height=[0.0]*len(parent)
+        for i in self.preorder.tolist()[1:]: ## parents always come before their children
+            height[i]=height[parent[i]]+length[i]
+        isLeaf=self.isLeaf.tolist()
+        youngest=[height[i] if isLeaf[i] else -np.inf for i in range(len(parent))]
+        for i in reversed(self.preorder.tolist()[1:]): ## pass the youngest tip height up to every ancestor
+            if youngest[i]>youngest[parent[i]]:
+                youngest[parent[i]]=youngest[i]
+        self.height=np.array(height,dtype=np.float64)
+        self.childHeight=np.array(youngest,dtype=np.float64)
+        self.childHeight[self.isLeaf]=np.nan
+        self.treeHeight=float(self.height[self.tipOrder].max())
 
-        return reduced_tree ## return new tree
+    def setAbsoluteTime(self,date):
+        """ place all branches in absolute time by providing the date of the most recent tip """
+        self.absoluteTime=date-self.treeHeight+self.height
 
-def make_tree(data,ll,verbose=False):
+    def sortBranches(self,descending=True):
+        """ Sort descendants of each node by number of descendant tips, then branch length, and redraw. """
+        modifier=-1 if descending==True else 1
+        numChildren=(self.lastTip-self.firstTip).tolist()
+        length=np.nan_to_num(self.length).tolist()
+        isLeaf=self.isLeaf.tolist()
+        childIds=self.childIds.tolist()
+        offsets=self.childOffsets.tolist()
+        for i in np.flatnonzero(~self.isLeaf).tolist():
+            children=childIds[offsets[i]:offsets[i+1]]
+            nodes=sorted([c for c in children if not isLeaf[c]],key=lambda c:(-numChildren[c]*modifier,length[c]*modifier))
+            leaves=sorted([c for c in children if isLeaf[c]],key=lambda c:length[c]*modifier)
+            childIds[offsets[i]:offsets[i+1]]=nodes+leaves if modifier==1 else leaves+nodes
+        self.childIds=np.array(childIds,dtype=np.int64)
+        self._index_tips()
+        self.drawTree()
+
+    def drawTree(self):
+        """ Rectangular layout: x is height, tips are spread along y in tip order, nodes sit in the middle of their children. """
+        ntips=len(self.tipOrder)
+        self.x=self.height.copy()
+        y=np.zeros(len(self.parent),dtype=np.float64)
+        y[self.tipOrder]=ntips-np.arange(ntips) ## first tip at the top
+        y=y.tolist()
+        offsets=self.childOffsets.tolist()
+        childIds=self.childIds.tolist()
+        for i in reversed(self.preorder.tolist()): ## children are placed before their parents
+            if offsets[i+1]>offsets[i]:
+                children=childIds[offsets[i]:offsets[i+1]]
+                y[i]=sum(y[c] for c in children)/float(len(children))
+        self.y=np.array(y,dtype=np.float64)
+        self.ySpan=float(ntips)
+
+    def toFlat(self):
+        """ Same flat dictionary as tree.toFlat(), ready for tree_from_flat(). """
+        order=self.preorder.tolist()
+        position={i:p for p,i in enumerate(order)}
+        column=lambda arr: [None if v!=v else v for v in arr[self.preorder].tolist()]
+        flat={'branchType':['leaf' if self.isLeaf[i] else 'node' for i in order],
+              'parent':[-1]+[position[i] for i in self.parent[self.preorder[1:]].tolist()],
+              'index':[self.index[i] for i in order],
+              'name':[self.name[i] for i in order],
+              'numName':[self.numName[i] for i in order],
+              'traits':[self.traits[i] if self.traits[i] is not None else {} for i in order],
+              'objects':[position[i] for i in self.objectOrder.tolist()],
+              'tipMap':self.tipMap,
+              'treeHeight':self.treeHeight,
+              'ySpan':self.ySpan}
+        for col in ['length','height','absoluteTime','x','y','childHeight']:
+            flat[col]=column(getattr(self,col))
+        return flat
+
+    def toTree(self):
+        """ Convert back to a tree of node and leaf objects. """
+        return tree_from_flat(self.toFlat())
+
+def _hull(px,py,candidates):
+    """ Convex hull (counterclockwise, without collinear points) of the points with the given indices. """
+    if len(candidates)<=2:
+        return candidates
+    order=np.lexsort((py[candidates],px[candidates]))
+    points=list(zip(px[candidates][order].tolist(),py[candidates][order].tolist(),candidates[order].tolist()))
+    def half(points):
+        chain=[]
+        for p in points:
+            while len(chain)>=2 and (chain[-1][0]-chain[-2][0])*(p[1]-chain[-2][1])-(chain[-1][1]-chain[-2][1])*(p[0]-chain[-2][0])<=0:
+                chain.pop()
+            chain.append(p)
+        return chain[:-1]
+    chain=half(points)+half(points[::-1])
+    if len(chain)==0: ## all points in the same place
+        chain=points[:1]
+    return np.array([p[2] for p in chain],dtype=np.int64)
+
+def _hull_add(px,py,polygon,candidates):
+    """ Convex hull (counterclockwise) of a convex polygon from _hull() and a few more points with the given indices. """
+    for p in candidates.tolist():
+        ax=px[polygon]
+        ay=py[polygon]
+        bx=np.concatenate((ax[1:],ax[:1])) ## far end of each edge
+        by=np.concatenate((ay[1:],ay[:1]))
+        visible=(bx-ax)*(py[p]-ay)-(by-ay)*(px[p]-ax)<0 ## edges that the point lies outside of
+        if visible.any():
+            m=len(polygon)
+            before=np.concatenate((visible[-1:],visible[:-1]))
+            s=int(np.flatnonzero(visible&~before)[0]) ## corners either side of the visible edges stay
+            e=int(np.flatnonzero(~visible&before)[0])
+            polygon=np.append(polygon[(e+np.arange((s-e)%m+1))%m],p)
+    return polygon
+
+def equal_daylight(x,y,parent,isTip,passes=5,tolerance=1e-4,smallest=64):
+    """ Equal-daylight refinement of an unrooted layout (Felsenstein's drawtree). The subtrees hanging off each node are
+    rotated about it so that the empty angles ("daylight") between them, as seen from the node, are equal.
+    x, y: NumPy arrays of coordinates in preorder, modified in place. The first entry is a fixed anchor point.
+    parent: preorder position of each branch's parent (-1 for the anchor).
+    isTip: boolean array, True for tips, whose positions define how much of the view each subtree takes up.
+    passes: maximum number of passes over all nodes.
+    tolerance: stop once no subtree turns by more than this (in radians) during a pass.
+    smallest: subtrees with up to this many tips are looked at tip by tip, larger ones through their convex hull.
+    A node looks at its children's subtrees and at everything outside its own subtree through the corners of their convex
+    hulls. Subtree hulls are rebuilt from the children's once all of a subtree's nodes have been dealt with in a pass
+    (rotating a whole subtree leaves the corners where they are), the hull of everything outside a node is built from its
+    parent's and its siblings' when the node is reached. Only a hull that surrounds the node or straddles the direction
+    opposite the group it belongs to is opened up into smaller pieces, so a pass takes seconds for tens of thousands of
+    tips, however deep the tree. """
+    N=len(x)
+    size=[1]*N ## number of branches in each subtree, which occupies preorder positions i to i+size[i]
+    children=[[] for i in range(N)]
+    parent_list=parent.tolist()
+    for i in range(N-1,0,-1):
+        size[parent_list[i]]+=size[i]
+        children[parent_list[i]].append(i)
+    for c in children:
+        c.reverse()
+    tips=np.flatnonzero(isTip)
+    first=np.searchsorted(tips,np.arange(N)).tolist() ## tips of subtree i are tips[first[i]:last[i]]
+    last=np.searchsorted(tips,np.arange(N)+np.array(size)).tolist()
+    xy=np.vstack([x,y])
+    px,py=xy
+    isTip=isTip.tolist()
+
+    ## pieces of the tree are subtrees, given by their preorder position i, or everything outside subtree i, given by -i-1
+    small=[last[i]-first[i]<=smallest for i in range(N)]
+    hulls=[tips[first[i]:last[i]] if small[i] else None for i in range(N)] ## tips (preorder positions) at the corners of each large subtree's convex hull, or all tips of a small one
+    outer=[None]*N ## corners of the hull of everything outside each node's subtree, built when the node is reached
+    anchor=np.array([0] if isTip[0] else [],dtype=np.int64)
+    def corners(s):
+        return outer[-s-1] if s<0 else hulls[s]
+
+    def merge(pieces,extra):
+        """ Hull of some pieces and extra tips, grown from the largest hull among them if only a few tips are left over. """
+        polygons=[s for s in pieces if (s<0 or not small[s]) and len(corners(s))>2]
+        if len(polygons)>0:
+            base=max(polygons,key=lambda s:len(corners(s)))
+            rest=np.concatenate([corners(s) for s in pieces if s!=base]+[extra])
+            if len(rest)<=8: ## e.g. a tip joining a large subtree
+                return _hull_add(px,py,corners(base),rest)
+        return _hull(px,py,np.concatenate([corners(s) for s in pieces]+[extra]))
+
+    def rebuild(i):
+        if not small[i]:
+            hulls[i]=merge(children[i],anchor[:0])
+    for i in range(N-1,-1,-1):
+        rebuild(i)
+    siblings=[[]]+[[s for s in children[parent_list[i]] if s!=i and last[s]>first[s]] for i in range(1,N)]
+
+    def beyond(i):
+        """ Pieces that make up everything outside subtree i: whatever is outside its parent and its siblings. """
+        j=parent_list[i]
+        return ([] if j==0 else [-j-1])+siblings[i]
+
+    opened={}
+    def open_up(s):
+        """ Split a large subtree into a few smaller ones (splitting the largest first) that hold all of its tips. """
+        if s not in opened:
+            parts=[(first[s]-last[s],s)]
+            while len(parts)<8 and not small[parts[0][1]]:
+                tipCount,k=heapq.heappop(parts)
+                for c in children[k]:
+                    if last[c]>first[c]:
+                        heapq.heappush(parts,(first[c]-last[c],c))
+            opened[s]=[k for tipCount,k in parts]
+        return opened[s]
+    hulls.append(anchor) ## the anchor, as a piece of its own at position N
+    small.append(True)
+
+    def bearing(points,vx,vy):
+        """ Directions from (vx,vy) to the branches at some preorder positions. Branches right on top of (vx,vy), e.g. at the end
+        of a zero-length branch, point along the x axis of the frame the tree is put back in at the end. """
+        dx=px[points]-vx
+        dy=py[points]-vy
+        angle=np.arctan2(dy,dx)
+        angle[(dx==0.0)&(dy==0.0)]=-spin
+        return angle
+
+    def whole(vx,vy,s,reference):
+        """ Whether a hull is seen whole from (vx,vy), i.e. neither surrounds it nor straddles the cut opposite the reference
+        direction, and if so the range of angles relative to the reference it covers. """
+        points=corners(s)
+        if len(points)==0:
+            return True,0.0,0.0
+        rel=(bearing(points,vx,vy)-(reference-math.pi))%(2*math.pi)-math.pi
+        if len(points)>1 and (np.abs(np.diff(rel)).max()>=math.pi or abs(rel[0]-rel[-1])>=math.pi):
+            return False,0.0,0.0
+        return True,min(0.0,float(rel.min())),max(0.0,float(rel.max()))
+
+    def extents(vx,vy,pieces,groups,references):
+        """ Range of angles, relative to a reference direction, covered by each group of pieces seen from (vx,vy).
+        pieces: pieces of the tree, groups: which group each of them belongs to, references: reference direction of each group. """
+        lo=[0.0]*len(references)
+        hi=[0.0]*len(references)
+        while pieces:
+            arrays=[corners(s) for s in pieces]
+            lengths=[len(a) for a in arrays]
+            points=np.concatenate(arrays)
+            angle=bearing(points,vx,vy)
+            rel=(angle-np.repeat([references[g]-math.pi for g in groups],lengths))%(2*math.pi)-math.pi
+            ends=np.cumsum(lengths)
+            starts=ends-lengths
+            following=np.arange(1,len(points)+1)
+            following[ends-1]=starts ## next corner around each hull
+            crossing=np.abs(rel[following]-rel)>=math.pi ## an edge of the hull crosses the cut, so its corners are not enough
+            bad=np.logical_or.reduceat(crossing,starts).tolist()
+            lows=np.minimum.reduceat(rel,starts).tolist()
+            highs=np.maximum.reduceat(rel,starts).tolist()
+            refined=[]
+            for s,g,b,l,h in zip(pieces,groups,bad,lows,highs):
+                if b and not small[s]:
+                    refined+=[(c,g) for c in open_up(s)]
+                else:
+                    lo[g]=min(lo[g],l)
+                    hi[g]=max(hi[g],h)
+            pieces=[s for s,g in refined if len(corners(s))>0]
+            groups=[g for s,g in refined if len(corners(s))>0]
+        return lo,hi
+
+    def rotate(a,b,theta,vx,vy):
+        """ Turn the branches at preorder positions a to b by theta about (vx,vy). """
+        cos,sin=math.cos(theta),math.sin(theta)
+        dx=px[a:b]-vx
+        dy=py[a:b]-vy
+        px[a:b]=vx+cos*dx-sin*dy
+        py[a:b]=vy+sin*dx+cos*dy
+
+    ## a node may keep its largest part in place and turn everything else the other way instead,
+    ## the turns owed to the whole tree are collected in rotation and shift and applied at the end
+    rotation=np.identity(2)
+    shift=np.zeros(2)
+    spin=0.0 ## angle of rotation
+    for p in range(passes):
+        turned=0.0
+        path=[0] ## nodes from the anchor down to the current one
+        for i in range(1,N):
+            if not isTip[i]:
+                while path[-1]!=parent_list[i]:
+                    path.pop()
+                path.append(i)
+                outer[i]=merge(beyond(i),anchor if parent_list[i]==0 else anchor[:0]) ## everything outside this node's subtree stays put while it is dealt with
+                vx,vy=xy[0,i],xy[1,i]
+                j=parent_list[i]
+                references=bearing([j]+children[i],vx,vy).tolist()
+                ## hulls of what is outside nodes further up the path are smaller, so once one is seen whole so are all above it:
+                ## find the deepest one by bisection and add the siblings of the nodes below it separately
+                seen,outside_lo,outside_hi=whole(vx,vy,-i-1,references[0])
+                k=len(path)-1
+                if not seen:
+                    k=0
+                    lower,upper=1,len(path)-2
+                    while lower<=upper:
+                        middle=(lower+upper)//2
+                        result=whole(vx,vy,-path[middle]-1,references[0])
+                        if result[0]:
+                            k=middle
+                            seen,outside_lo,outside_hi=result
+                            lower=middle+1
+                        else:
+                            upper=middle-1
+                pieces=[s for a in path[k+1:] for s in siblings[a]]+([N] if k==0 and len(anchor)>0 else [])
+                groups=[0]*len(pieces)
+                for g,c in enumerate(children[i],start=1):
+                    if last[c]>first[c]:
+                        pieces.append(c)
+                        groups.append(g)
+                lows,highs=extents(vx,vy,pieces,groups,references)
+                lows[0]=min(lows[0],outside_lo)
+                highs[0]=max(highs[0],outside_hi)
+                fixed_end=references[0]+highs[0]
+                used=highs[0]-lows[0]
+                subtrees=[]
+                for c,reference,lo,hi in zip(children[i],references[1:],lows[1:],highs[1:]):
+                    subtrees.append(((reference+lo-fixed_end)%(2*math.pi),c,reference+lo,hi-lo))
+                    used+=hi-lo
+                gap=(2*math.pi-used)/float(len(subtrees)+1)
+                if gap>0: ## otherwise subtrees overlap whichever way they are turned
+                    cursor=fixed_end+gap
+                    turns={}
+                    for order,c,start,span in sorted(subtrees): ## counterclockwise from the fixed part
+                        theta=(cursor-start+math.pi)%(2*math.pi)-math.pi
+                        cursor+=span+gap
+                        if theta!=0.0:
+                            turns[c]=theta
+                            turned=max(turned,abs(theta))
+                    heavy=max(children[i],key=lambda c:size[c])
+                    if heavy in turns and N-size[heavy]<size[heavy]: ## cheaper to turn everything but the heaviest child back
+                        theta=turns.pop(heavy)
+                        rotate(0,heavy,-theta,vx,vy)
+                        rotate(heavy+size[heavy],N,-theta,vx,vy)
+                        cos,sin=math.cos(theta),math.sin(theta)
+                        turn=np.array([[cos,-sin],[sin,cos]])
+                        shift=shift+rotation@(np.array([vx,vy])-turn@np.array([vx,vy]))
+                        rotation=rotation@turn
+                        spin=(spin+theta)%(2*math.pi)
+                    for c,theta in turns.items(): ## rotate the subtree about the node
+                        rotate(c,c+size[c],theta,vx,vy)
+            a=parent_list[i]
+            while a!=-1 and a+size[a]-1==i: ## every subtree ending here is done for this pass
+                rebuild(a)
+                a=parent_list[a]
+        if turned<tolerance:
+            break
+    x[:]=rotation[0,0]*px+rotation[0,1]*py+shift[0]
+    y[:]=rotation[1,0]*px+rotation[1,1]*py+shift[1]
+
+def tree_from_flat(flat,compact=None):
+    """ Rebuild a tree object from the output of tree.toFlat().
+    compact overrides whether the rebuilt tree uses the compact branch classes, by default it follows the flattened tree. """
+    if compact is None:
+        compact=flat.get('compact',False)
+    ll=tree(compact=compact)
+    node_class,leaf_class=(compact_node,compact_leaf) if compact else (node,leaf)
+    objs=[]
+    for i,branchType in enumerate(flat['branchType']):
+        if i==0:
+            k=ll.root
+        else:
+            k=node_class() if branchType=='node' else leaf_class()
+            k.parent=objs[flat['parent'][i]] ## parents always precede their children in preorder
+            k.parent.children.append(k)
+            if branchType=='leaf':
+                k.name=flat['name'][i]
+                k.numName=flat['numName'][i]
+            else:
+                k.childHeight=flat['childHeight'][i]
+        k.index=flat['index'][i]
+        k.length=flat['length'][i]
+        k.height=flat['height'][i]
+        k.absoluteTime=flat['absoluteTime'][i]
+        k.x=flat['x'][i]
+        k.y=flat['y'][i]
+        k.traits=copy.copy(flat['traits'][i])
+        objs.append(k)
+
+    ll._index_tips(objs) ## objs are in preorder
+    for k in objs:
+        if k.branchType=='node':
+            k.numChildren=k.lastTip-k.firstTip
+
+    ll.Objects=[objs[i] for i in flat['objects']]
+    ll.nodes=[k for k in ll.Objects if isinstance(k,node_base)]
+    ll.leaves=[k for k in ll.Objects if isinstance(k,leaf_base)]
+    ll.tipMap=flat['tipMap']
+    ll.treeHeight=flat['treeHeight']
+    ll.ySpan=flat['ySpan']
+    return ll
+
+def make_tree(data,ll,verbose=False,engine='regex',lazy=False,trait_keys=None):
     """
     data is a tree string, ll (LL) is an (empty?) instance of a tree object
+    engine selects the parser: 'regex' (default) or 'fast', see make_tree_fast()
+    lazy and trait_keys control how [&...] comments are decoded, see assign_comment()
     """
+    if engine=='fast':
+        return make_tree_fast(data,ll,verbose=verbose,lazy=lazy,trait_keys=trait_keys)
+    assert engine=='regex','Unknown tree parsing engine: %s'%(engine)
+
     i=0 ## is an adjustable index along the tree string, it is incremented to advance through the string
     stored_i=None ## store the i at the end of the loop, to make sure we haven't gotten stuck somewhere in an infinite loop
 
@@ -834,47 +2340,7 @@ def make_tree(data,ll,verbose=False):
         if cerberus is not None:
             if verbose==True:
                 print('%d comment: %s'%(i,cerberus.group(2)))
-            comment=cerberus.group(2)
-            numerics=re.findall('[A-Za-z\_\.0-9]+=[0-9\-Ee\.]+',comment) ## find all entries that have values as floats
-            strings=re.findall('[A-Za-z\_\.0-9]+=["|\']*[A-Za-z\_0-9\.\+]+["|\']*',comment) ## strings
-            treelist=re.findall('[A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\.]+}',comment) ## complete history logged robust counting (MCMC trees)
-            sets=re.findall('[A-Za-z\_\.0-9\%]+={[A-Za-z\.\-0-9eE,\"\_]+}',comment) ## sets and ranges
-            figtree=re.findall('\![A-Za-z]+=[A-Za-z0-9#]+',comment)
-
-            for vals in strings:
-                tr,val=vals.split('=')
-                if '+' in val:
-                    val=val.split('+')[0] ## DO NOT ALLOW EQUIPROBABLE DOUBLE ANNOTATIONS (which are in format "A+B") - just get the first one
-                ll.cur_node.traits[tr]=val.strip('"')
-
-            for vals in numerics: ## assign all parsed annotations to traits of current branch
-                tr,val=vals.split('=') ## split each value by =, left side is name, right side is value
-                ll.cur_node.traits[tr]=float(val)
-
-            for val in treelist:
-                tr,val=val.split('=')
-                microcerberus=re.findall('{([0-9]+,[0-9\.\-e]+,[A-Z]+,[A-Z]+)}',val)
-                ll.cur_node.traits[tr]=[]
-                for val in microcerberus:
-                    codon,timing,start,end=val.split(',')
-                    ll.cur_node.traits[tr].append((int(codon),float(timing),start,end))
-
-            for vals in sets:
-                tr,val=vals.split('=')
-                if 'set' in tr:
-                    ll.cur_node.traits[tr]=[]
-                    for v in val[1:-1].split(','):
-                        if 'set.prob' in tr:
-                            ll.cur_node.traits[tr].append(float(v))
-                        else:
-                            ll.cur_node.traits[tr].append(v.strip('"'))
-                elif 'range' in tr or 'HPD' in tr:
-                    ll.cur_node.traits[tr]=map(float,val[1:-1].split(','))
-                else:
-                    print('some other trait: %s'%(vals))
-
-            if len(figtree)>0:
-                print('FigTree comment found, ignoring')
+            assign_comment(ll.cur_node,cerberus.group(2),lazy,trait_keys) ## assign all parsed annotations to traits of current branch
 
             i+=len(cerberus.group()) ## advance in tree string by however many characters it took to encode labels
 
@@ -901,6 +2367,94 @@ def make_tree(data,ll,verbose=False):
             break ## end loop
 
 
+_token_regex=r"""\s*(?:(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<end>;)|\[(?P<comment>[^\]]*)\]|(?P<colon>:)|(?P<quoted>'[^']*'|"[^"]*")|(?P<name>[^\s:\[\],();'"]+))"""
+_token_str=re.compile(_token_regex)
+_token_bytes=re.compile(_token_regex.encode())
+_peek_str=re.compile(r'\s*\[')
+_peek_bytes=re.compile(rb'\s*\[')
+
+def make_tree_fast(data,ll,verbose=False,start=0,end=None,lazy=False,trait_keys=None):
+    """
+    Single pass tree string parser, builds the same objects as make_tree() without repeated regex matching on slices of the tree string.
+    data is a tree string (str, or anything bytes-like, e.g. an mmap), ll is an empty instance of a tree object.
+    start and end delimit the tree string within data, object indices are relative to start.
+    lazy and trait_keys control how [&...] comments are decoded, see assign_comment().
+    """
+    if end is None:
+        end=len(data)
+    isbytes=not isinstance(data,str)
+    if isbytes:
+        token,peek=_token_bytes.match,_peek_bytes.match
+    else:
+        token,peek=_token_str.match,_peek_str.match
+
+    i=start ## cursor along the tree string
+    expect_child=True ## names encountered after ( or , are tips, after ) they are node labels
+    expect_length=False ## names encountered after : are branch lengths
+
+    while i<end:
+        cerberus=token(data,i,end)
+        if cerberus is None:
+            rest=data[i:min(end,i+5000)]
+            assert len(rest.strip())==0,'\nTree string unparseable\nstring region looks like this: %s'%(rest)
+            break
+
+        kind=cerberus.lastgroup
+        position=cerberus.start(kind)-start ## same positional index that make_tree() would assign
+        i=cerberus.end()
+
+        if kind=='open': ## new node
+            if verbose==True:
+                print('%d adding node'%(position))
+            ll.add_node(position)
+            expect_child=True
+
+        elif kind=='comma' or kind=='close': ## bifurcation or clade end
+            ll.cur_node=ll.cur_node.parent
+            expect_child=(kind=='comma')
+            expect_length=False
+
+        elif kind=='end': ## string end
+            break
+
+        elif kind=='colon':
+            expect_length=True
+
+        elif kind=='comment':
+            comment=cerberus.group(kind)
+            if isbytes:
+                comment=comment.decode()
+            if comment.startswith('&'): ## MCC comments, anything else is ignored
+                if verbose==True:
+                    print('%d comment: %s'%(position,comment[1:]))
+                assign_comment(ll.cur_node,comment[1:],lazy,trait_keys)
+
+        else: ## tip names, node labels or branch lengths
+            text=cerberus.group(kind)
+            if isbytes:
+                text=text.decode()
+            if kind=='quoted':
+                text=text[1:-1]
+
+            if expect_length:
+                if verbose==True:
+                    print('adding branch length (%d) %s'%(position,text))
+                ll.cur_node.length=float(text)
+                expect_length=False
+            elif expect_child:
+                if verbose==True:
+                    print('%d adding leaf %s'%(position,text))
+                ll.add_leaf(position,text)
+                expect_child=False
+            elif text.isdigit() and peek(data,i,end) is not None: ## multitype tree singletons
+                if verbose==True:
+                    print('%d adding multitype node %s'%(position,text))
+            else: ## old school node labels
+                if verbose==True:
+                    print('old school comment found: %s'%(text))
+                ll.cur_node.traits['label']=text
+
+
 if __name__ == '__main__':
     import sys
     ll=tree()
@@ -1,10 +1,12 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from matplotlib.collections import LineCollection
 
 
 import re
 import copy
 import math
+import itertools
 import numpy as np
 import pandas as pd
 
@@ -15,6 +17,16 @@ import datetime
 from dateutil.relativedelta import relativedelta as rd
 from datetime import timedelta
 import time
+import functools
+
+# file scanning and caching
+import os
+import mmap
+import json
+import hashlib
+
+# parallel loading
+from concurrent.futures import ProcessPoolExecutor
 
 """A bunch of functions which I wrote to support baltic3.py.
 """
@@ -38,6 +50,40 @@ def get_leaf(tree, tipname):
     return lf
 
 
+def radial_segments(tree, arc_step=0.02):
+    """Line segments of a tree drawn with tree.drawRadial(), ready for a matplotlib LineCollection.
+    Each branch is a radial line at its own angle from its parent's distance to its own, and each node
+    is an arc joining its children's angles at the node's distance from the centre.
+
+    PARAMS
+    ------
+    tree: baltic tree object, with a radial layout.
+    arc_step: float; largest angle (radians) covered by one straight piece of an arc.
+
+    RETURNS
+    -------
+    segments: list of arrays of (x, y) points, one per branch and one per node arc.
+    """
+    index = {id(k): i for i, k in enumerate(tree.Objects)}
+    parent = np.array([index.get(id(k.parent), -1) for k in tree.Objects], dtype=np.int64)
+    parent_radii = np.where(parent >= 0, tree.radii[parent], 0.0)  # the root sits in the centre
+
+    cos = np.cos(tree.thetas)
+    sin = np.sin(tree.thetas)
+    radial = np.stack([np.stack([parent_radii*cos, parent_radii*sin], axis=1),
+                       np.stack([tree.radii*cos, tree.radii*sin], axis=1)], axis=1)
+    segments = list(radial)
+
+    for i, k in enumerate(tree.Objects):
+        if k.branchType == 'node' and len(k.children) > 1:
+            angles = [tree.thetas[index[id(ch)]] for ch in k.children]
+            lo, hi = min(angles), max(angles)
+            theta = np.linspace(lo, hi, int((hi - lo)/arc_step) + 2)
+            segments.append(np.stack([tree.radii[i]*np.cos(theta), tree.radii[i]*np.sin(theta)], axis=1))
+
+    return segments
+
+
 def quick_draw_tree(tree, 
                     colour_by = "",
                     values_of_interest = [],
@@ -49,7 +95,11 @@ def quick_draw_tree(tree,
                     x_offset=0, 
                     save_fn = "",
                     verbose=True,
-                    show_borders=False):
+                    show_borders=False,
+                    layout="rectangular",
+                    radial_start=0.0,
+                    radial_span=2*math.pi,
+                    radial_gap=0.0):
     """
     Draws a tree, and colours a set of tips based on an (optional) input dataframe, dm, with a column of interest, `colname`. 
     
@@ -72,6 +122,11 @@ def quick_draw_tree(tree,
     save_fn: str; output filename. Does not save if left blank.
     verbose: Boolean; verbosity param
     show_borders: Boolean; if true, show axes and border elements. 
+    layout: str; "rectangular" (default) or "radial", which wraps the tree around the root (see tree.drawRadial()) so
+    that large trees fit on a single figure.
+    radial_start: float; angle (radians) at which the first tip is placed in a radial layout.
+    radial_span: float; angle covered by a radial layout, less than 2*pi for a partial arc.
+    radial_gap: float; empty angle left at the end of a radial layout's arc.
 
     Returns
     -------
@@ -90,7 +145,31 @@ def quick_draw_tree(tree,
     # ==================== Plot! ====================
     fig,ax = plt.subplots(figsize=(fig_w, fig_h),facecolor='w')
 
-    for k in tree.Objects:
+    if layout == "radial":
+        tree.drawRadial(start=radial_start, span=radial_span, gap=radial_gap)
+        ax.add_collection(LineCollection(radial_segments(tree),
+                                         lw=branch_width,
+                                         color=branch_colour,ls='-',zorder=9))
+        ax.set_aspect('equal')
+        ax.autoscale_view()
+
+    for i,k in enumerate(tree.Objects):
+        if layout == "radial":
+            # branches are already drawn, only tips are left
+            x = tree.xs[i]
+            y = tree.ys[i]
+            if isinstance(k,bt.leaf_base) or k.branchType=='leaf':
+                if colour_by != "" and k.traits[colour_by] in list(c_dict.keys()):
+                    ax.scatter(x, y, facecolor=c_dict[k.traits[colour_by]],
+                               edgecolor='none',
+                               s=tip_shape_size,
+                               zorder=10)
+                    ax.scatter(x,y,s=tip_shape_size+0.8*tip_shape_size,
+                               facecolor='k',
+                               edgecolor='none',
+                               zorder=9)
+            continue
+
         x=k.height
         y=k.y
 
@@ -100,7 +179,7 @@ def quick_draw_tree(tree,
         if xp==None:
             xp = x + x_offset
 
-        if isinstance(k,bt.leaf) or k.branchType=='leaf':
+        if isinstance(k,bt.leaf_base) or k.branchType=='leaf':
             if colour_by != "":
                 # colour only those tips identified in c_dict
                 if k.traits[colour_by] in list(c_dict.keys()):
@@ -116,7 +195,7 @@ def quick_draw_tree(tree,
             else:
                 pass
 
-        elif isinstance(k,bt.node) or k.branchType=='node':
+        elif isinstance(k,bt.node_base) or k.branchType=='node':
             ax.plot([x,x],
                     [k.children[-1].y,k.children[0].y],
                     lw=branch_width,
@@ -135,8 +214,10 @@ def quick_draw_tree(tree,
 
     # scale bar
     scalebar_y = -tree.ySpan*0.05
+    if layout == "radial":
+        scalebar_y = -tree.treeHeight*1.05
     ax.plot([0, 0.01], [scalebar_y, scalebar_y], c="k", lw=branch_width*2)
-    ax.text(0.005, -tree.ySpan*0.045, "0.01", 
+    ax.text(0.005, scalebar_y*0.9, "0.01", 
             verticalalignment="bottom", 
             horizontalalignment="center")
     
@@ -154,7 +235,15 @@ def quick_draw_tree(tree,
     plt.show()
 
 
-def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_", make_tree_verbose=False):
+def _tree_string_start(line):
+    """ Position of the first '(' in a line that matched as a tree line, where its tree string starts. """
+    start=line.find('(')
+    if start==-1:
+        raise ValueError('No tree string found on tree line: %s'%(line.strip()))
+    return start
+
+
+def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_", make_tree_verbose=False, engine="regex", lazy=False, trait_keys=None, compact=False, cache_dir=None, cache_max_bytes=2**29):
     """Lifted from the austechia.ipynb (thus the name). 
     This works for BEAST and RAXML trees, or raw newick strings, but not really for treetime or LSD dated trees. 
     This is more because of the output: treetime-dated trees don't have the absoluteTime directly written in the newick strings. 
@@ -173,11 +262,23 @@ def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_",
     Calendar dates must be in yyyy-mm-dd, yyyy-mm or yyyy format. 
     date_delimiter: delimiter vale to read date off the tipname. 
     make_tree_verbose: Bool; verbosity parameter.
+    engine: str; tree string parser passed to make_tree(), 'regex' (default) or 'fast'.
+    lazy: Bool; if True, keep each branch's raw annotation comment and decode traits only when first accessed.
+    trait_keys: list of str; trait names to decode at parse time. Without `lazy`, all other traits are discarded.
+    compact: Bool; if True, build the tree from the memory-saving slotted branch classes and share trait name strings
+    between branches (see tree.internTraitKeys()).
+    cache_dir: str; if given, parsed trees are cached in this directory, keyed by the file's content hash and
+    the other arguments, and reloaded from there on later calls (see save_tree_npz()).
+    cache_max_bytes: int; size limit of `cache_dir`, least recently used entries are evicted beyond it.
 
     RETURNS
     -------
     ll: baltic tree object. 
     """
+    if cache_dir is not None:
+        kwargs=dict(date_bool=date_bool, date_pos=date_pos, date_delim=date_delim, engine=engine, lazy=lazy, trait_keys=trait_keys, compact=compact)
+        return _cached_read(austechia_read_tree, tree_path, kwargs, cache_dir, cache_max_bytes)
+
     tipFlag=False
     tips={}
 
@@ -191,9 +292,11 @@ def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_",
         #####################
         cerberus=re.search('tree TREE([0-9]+) = \[&R\]',l) ## search for beginning of tree string in BEAST format
         if cerberus is not None:
-            treeString_start=l.index('(') ## tree string starts where the first '(' is in the line
-            ll=bt.tree() ## new instance of tree
-            bt.make_tree(l[treeString_start:],ll, verbose=make_tree_verbose) ## send tree string to make_tree function, provide an empty tree object
+            treeString_start=_tree_string_start(l) ## tree string starts where the first '(' is in the line
+            ll=bt.tree(compact=compact) ## new instance of tree
+            bt.make_tree(l[treeString_start:],ll, verbose=make_tree_verbose, engine=engine, lazy=lazy, trait_keys=trait_keys) ## send tree string to make_tree function, provide an empty tree object
+            if compact:
+                ll.internTraitKeys()
         #####################
 
         if tipFlag==True:
@@ -213,17 +316,17 @@ def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_",
     ## rename tips, find the highest tip (in absolute time) in the tree
     if len(tips)==0:
         for k in ll.Objects:
-            if isinstance(k,bt.leaf):
+            if isinstance(k,bt.leaf_base):
                 k.name=k.numName
 
         # read the tip date. Accepts decimal or calendar dates;
         # converts to a decidate if required.
         if date_bool:
-            highestTip=max([decimalDate(x.name.strip("'").split(date_delim)[date_pos],variable=True) for x in ll.Objects if isinstance(x,bt.leaf)])
+            highestTip=decimalDates([x.name.strip("'").split(date_delim)[date_pos] for x in ll.Objects if isinstance(x,bt.leaf_base)],variable=True).max()
     else: ## there's a tip name map at the beginning, so translate the names
         ll.renameTips(tips) ## give each tip a name
         if date_bool:
-            highestTip=max([decimalDate(x.strip("'").split(date_delim)[date_pos],variable=True) for x in tips.values()])
+            highestTip=decimalDates([x.strip("'").split(date_delim)[date_pos] for x in tips.values()],variable=True).max()
 
     ll.treeStats()
     ll.sortBranches(descending=False)
@@ -235,9 +338,21 @@ def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_",
     return ll
 
 
-def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False):
+def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False,engine='regex',lazy=False,trait_keys=None,compact=False,cache_dir=None,cache_max_bytes=2**29):
     """Gytis' original tree-reading function.
+    engine selects the tree string parser used by make_tree(), 'regex' (default) or 'fast'.
+    lazy and trait_keys control how annotations are decoded, compact builds a memory-saving tree,
+    cache_dir and cache_max_bytes control on-disk caching of parsed trees, see austechia_read_tree().
     """
+    if cache_dir is not None and isinstance(tree_path,str):
+        kwargs=dict(tip_regex=tip_regex,date_fmt=date_fmt,treestring_regex=treestring_regex,variableDate=variableDate,absoluteTime=absoluteTime,engine=engine,lazy=lazy,trait_keys=trait_keys,compact=compact)
+        return _cached_read(loadNexus,tree_path,kwargs,cache_dir,cache_max_bytes)
+
+    if isinstance(tree_path,str) and engine=='fast' and os.path.getsize(tree_path)>0:
+        ll,tips=_scan_nexus(tree_path,treestring_regex,verbose,lazy,trait_keys,compact) ## single byte-level pass over a memory-mapped file
+        assert ll,'Regular expression failed to find tree string'
+        return _finish_nexus_tree(ll,tips,tip_regex,date_fmt,variableDate,absoluteTime,verbose)
+
     tipFlag=False
     tips={}
     tipNum=0
@@ -258,9 +373,11 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
 
         cerberus=re.search(treestring_regex,l)
         if cerberus is not None:
-            treeString_start=l.index('(')
-            ll=bt.tree() ## new instance of tree
-            bt.make_tree(l[treeString_start:],ll) ## send tree string to make_tree function
+            treeString_start=_tree_string_start(l)
+            ll=bt.tree(compact=compact) ## new instance of tree
+            bt.make_tree(l[treeString_start:],ll,engine=engine,lazy=lazy,trait_keys=trait_keys) ## send tree string to make_tree function
+            if compact:
+                ll.internTraitKeys()
             if verbose==True:
                 print('Identified tree string')
 
@@ -279,6 +396,165 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
             tipFlag=False
 
     assert ll,'Regular expression failed to find tree string'
+    return _finish_nexus_tree(ll,tips,tip_regex,date_fmt,variableDate,absoluteTime,verbose)
+
+
+def _scan_nexus(tree_path,treestring_regex,verbose=False,lazy=False,trait_keys=None,compact=False):
+    """Walks once through a memory-mapped copy of a NEXUS file, keeping track of which block it is in,
+    to find the dimensions, the translate table of the trees block and the (last) tree string,
+    which is parsed in place with make_tree_fast() without ever materialising it as a Python string.
+    The translate table and tree strings are skipped over rather than searched through.
+
+    RETURNS
+    -------
+    ll: baltic tree object, or None if `treestring_regex` never matched.
+    tips: dict; tip name map from the translate block, empty if there is none.
+    """
+    tips={}
+    ll=None
+    scanner=re.compile(rb'^[ \t]*(?i:begin)[ \t]+(?P<begin>\w+)[ \t]*;'
+                       rb'|^[ \t]*(?P<end>(?i:end|endblock))[ \t]*;'
+                       rb'|(?i:dimensions[ \t]+ntax=)(?P<ntax>[0-9]+)[ \t]*;'
+                       rb'|^[ \t]*(?P<translate>(?i:translate))\b'
+                       rb'|(?P<tree>'+treestring_regex.encode()+rb')',re.MULTILINE)
+    with open(tree_path,'rb') as handle, mmap.mmap(handle.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        block=None ## name of the block we are in, None outside of any
+        last=None ## line of the last tree string
+        position=0
+        while True:
+            cerberus=scanner.search(mm,position)
+            if cerberus is None:
+                break
+            position=cerberus.end()
+            if cerberus.group('begin') is not None:
+                block=cerberus.group('begin').decode().lower()
+            elif cerberus.group('end') is not None:
+                block=None
+            elif cerberus.group('ntax') is not None:
+                if verbose==True:
+                    print('File should contain %d taxa'%(int(cerberus.group('ntax'))))
+            elif cerberus.group('translate') is not None:
+                if block!='trees':
+                    continue
+                ## translate block runs from the line after the keyword to the line with the first ;
+                block_start=mm.find(b'\n',cerberus.end())+1
+                block_end=mm.find(b';',block_start)
+                block_end=mm.find(b'\n',block_end) if block_end!=-1 else -1
+                if block_end==-1:
+                    block_end=len(mm)
+                for l in mm[block_start:block_end].decode().split('\n'):
+                    cerberus=re.search('([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+                    if cerberus is not None:
+                        tips[cerberus.group(1)]=cerberus.group(2).strip('"').strip("'")
+                        if verbose==True:
+                            print('Identified tip translation %s: %s'%(cerberus.group(1),tips[cerberus.group(1)]))
+                    elif ';' not in l and len(l.strip())>0:
+                        print('tip not captured by regex:',l.replace('\t',''))
+                position=max(position,block_end)
+            elif block in ('trees',None): ## tree string, like loadNexus keep the last one in the file
+                line_start=mm.rfind(b'\n',0,cerberus.start())+1
+                line_end=mm.find(b'\n',cerberus.end())
+                if line_end==-1:
+                    line_end=len(mm)
+                last=(line_start,line_end)
+                position=max(position,line_end) ## no need to look through the tree string itself
+
+        if last is not None:
+            line_start,line_end=last
+            treeString_start=mm.find(b'(',line_start,line_end)
+            if treeString_start==-1:
+                raise ValueError('No tree string found on tree line: %s'%(mm[line_start:line_end].decode(errors='replace').strip()))
+            ll=bt.tree(compact=compact) ## new instance of tree
+            bt.make_tree_fast(mm,ll,start=treeString_start,end=line_end,lazy=lazy,trait_keys=trait_keys) ## parse straight out of the mapped file
+            if compact:
+                ll.internTraitKeys()
+            if verbose==True:
+                print('Identified tree string')
+    return ll,tips
+
+
+def iterNexus(tree_path,burnin=0,thin=1,max_trees=None,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False,engine='regex',lazy=False,trait_keys=None,compact=False):
+    """Streams trees out of a multi-tree NEXUS file, such as a BEAST posterior sample (.trees).
+    The translate block is parsed once, after which every tree line is turned into a baltic tree
+    (processed the same way as loadNexus() does) and yielded in file order. Only one tree string is in
+    memory at any time; trees discarded by burnin or thinning are never parsed.
+
+    Usage:
+    >>> for ll in iterNexus('posterior.trees', burnin=1000, thin=10):
+    ...     print(ll.treeHeight)
+
+    PARAMS
+    ------
+    tree_path: str or file handle; path to the NEXUS file.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; keep every `thin`-th tree after the burn-in.
+    max_trees: int; stop after yielding this many trees. None (default) reads to the end of the file.
+    engine: str; tree string parser passed to make_tree(), 'regex' (default) or 'fast'.
+    lazy: Bool; if True, decode annotations only when first accessed.
+    trait_keys: list of str; trait names to decode at parse time. Without `lazy`, all other traits are discarded.
+    compact: Bool; if True, build memory-saving trees that also share one table of trait names.
+    Other params as in loadNexus().
+
+    YIELDS
+    ------
+    ll: baltic tree object, one per retained tree in the file.
+    """
+    assert burnin>=0 and thin>=1,'burnin must be >=0 and thin must be >=1'
+    tipFlag=False
+    tips={}
+    seen=0 ## number of tree strings encountered so far
+    yielded=0
+    trait_names={} ## trait name strings shared by all trees in compact mode
+    if isinstance(tree_path,str):
+        handle=open(tree_path,'r')
+    else:
+        handle=tree_path
+
+    try:
+        for line in handle:
+            if max_trees is not None and yielded>=max_trees:
+                break
+
+            cerberus=re.search(treestring_regex,line)
+            if cerberus is not None and '(' in line:
+                seen+=1
+                if seen<=burnin or (seen-burnin-1)%thin!=0: ## skip without parsing
+                    continue
+                treeString_start=line.index('(')
+                ll=bt.tree(compact=compact) ## new instance of tree
+                bt.make_tree(line[treeString_start:].rstrip(),ll,engine=engine,lazy=lazy,trait_keys=trait_keys) ## send tree string to make_tree function
+                if compact:
+                    ll.internTraitKeys(trait_names)
+                line=None ## release the tree string before handing out the tree
+                yielded+=1
+                if verbose==True:
+                    print('Identified tree string %d'%(seen))
+                yield _finish_nexus_tree(ll,dict(tips),tip_regex,date_fmt,variableDate,absoluteTime,verbose)
+                continue
+
+            l=line.strip('\n')
+            if tipFlag==True:
+                cerberus=re.search('([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+                if cerberus is not None:
+                    tips[cerberus.group(1)]=cerberus.group(2).strip('"').strip("'")
+                    if verbose==True:
+                        print('Identified tip translation %s: %s'%(cerberus.group(1),tips[cerberus.group(1)]))
+                elif ';' not in l:
+                    print('tip not captured by regex:',l.replace('\t',''))
+
+            if 'translate' in l.lower():
+                tipFlag=True
+            if ';' in l:
+                tipFlag=False
+    finally:
+        if isinstance(tree_path,str):
+            handle.close()
+
+
+def _finish_nexus_tree(ll,tips,tip_regex,date_fmt,variableDate,absoluteTime,verbose):
+    """Traverses, sorts and draws a freshly parsed NEXUS tree, translates its tip names
+    and optionally places it in absolute time. Shared by loadNexus() and iterNexus().
+    """
     ll.traverse_tree() ## traverse tree
     ll.sortBranches() ## traverses tree, sorts branches, draws tree
     if verbose:
@@ -296,14 +572,254 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
 
             cerberus=re.search(tip_regex,n)
             if cerberus is not None:
-                tipDates.append(decimalDate(cerberus.group(1),fmt=date_fmt,variable=variableDate))
+                tipDates.append(cerberus.group(1))
 
-        highestTip=max(tipDates)
+        highestTip=decimalDates(tipDates,fmt=date_fmt,variable=variableDate).max() ## converts all tip dates at once
         ll.setAbsoluteTime(highestTip)
 
     return ll
 
 
+def write_nexus_trees(trees, handle, traits=[], numName=False, taxa=None, translate=True):
+    """Streams many trees (e.g. a reduced or collapsed posterior sample) into a single NEXUS file,
+    with one taxa block, one shared translate table and one `tree TREEn = [&R] ...` line per tree.
+    The output can be read back with loadNexus() or iterNexus().
+
+    PARAMS
+    ------
+    trees: iterable of baltic tree objects. May be a generator, trees are written as they come.
+    handle: str or file handle; output path or open text file/buffer.
+    traits: list of str; trait names to write out as [&...] annotations.
+    numName: Bool; write tips' numName instead of their (translated) name.
+    taxa: list of str; tip names for the taxa block and translate table. Defaults to the tips of the first tree.
+    translate: Bool; if True (default), tips are written as integers from the translate table.
+    """
+    trees=iter(trees)
+    first=next(trees,None)
+    assert first is not None,'No trees to write'
+    if taxa is None:
+        taxa=[k.numName if numName else k.name for k in first.Objects if k.branchType=='leaf']
+    table={name:str(i+1) for i,name in enumerate(taxa)} if translate else None
+
+    out=open(handle,'w') if isinstance(handle,str) else handle
+    try:
+        out.write('#NEXUS\n\nBegin taxa;\n\tDimensions ntax=%d;\n\tTaxlabels\n'%(len(taxa)))
+        for name in taxa:
+            out.write("\t\t'%s'\n"%(name))
+        out.write('\t\t;\nEnd;\n\nBegin trees;\n')
+        if translate:
+            out.write('\tTranslate\n')
+            out.write(',\n'.join("\t\t%s '%s'"%(table[name],name) for name in taxa))
+            out.write('\n;\n')
+        for i,ll in enumerate(itertools.chain([first],trees)):
+            out.write('tree TREE%d = [&R] '%(i+1))
+            ll.writeNewick(out,traits=traits,numName=numName,translate=table)
+            out.write('\n')
+        out.write('End;\n')
+    finally:
+        if isinstance(handle,str):
+            out.close()
+
+
+def _make_tree_worker(args):
+    """Process pool worker for batch_make_trees(): parses one tree string and returns it flattened."""
+    tree_string,engine,sort=args
+    ll=bt.tree()
+    bt.make_tree(tree_string,ll,engine=engine)
+    if sort:
+        ll.traverse_tree()
+        ll.sortBranches()
+    return ll.toFlat()
+
+
+def _loadNexus_worker(args):
+    """Process pool worker for batch_loadNexus(): loads one NEXUS file and returns it flattened."""
+    tree_path,kwargs=args
+    return loadNexus(tree_path,**kwargs).toFlat()
+
+
+def _run_pool(worker,jobs,workers,chunksize):
+    """Maps `worker` over `jobs` on a process pool, returns the rebuilt trees in input order."""
+    if workers==1: ## no point paying for a pool
+        return [bt.tree_from_flat(worker(job)) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [bt.tree_from_flat(flat) for flat in executor.map(worker,jobs,chunksize=chunksize)]
+
+
+def batch_make_trees(tree_strings, workers=None, chunksize=1, engine="regex", sort=True):
+    """Parses a collection of tree strings (bootstrap replicates, posterior samples, etc.)
+    in parallel on a process pool. Trees travel back from the workers flattened by
+    tree.toFlat(), rather than as pickled parent/children object graphs.
+
+    PARAMS
+    ------
+    tree_strings: iterable of str; newick tree strings, starting at the first '('.
+    workers: int; number of worker processes. None (default) uses one per CPU, 1 parses serially.
+    chunksize: int; number of tree strings sent to a worker at a time. Larger chunks suit many small trees.
+    engine: str; tree string parser passed to make_tree(), 'regex' (default) or 'fast'.
+    sort: Bool; if True (default), traverse, sort and draw each tree in the worker, as loadNexus() does.
+
+    RETURNS
+    -------
+    trees: list of baltic tree objects, in the same order as `tree_strings`.
+    """
+    jobs=[(tree_string,engine,sort) for tree_string in tree_strings]
+    return _run_pool(_make_tree_worker,jobs,workers,chunksize)
+
+
+def batch_loadNexus(tree_paths, workers=None, chunksize=1, **kwargs):
+    """Runs loadNexus() over a collection of files (e.g. per-clade FastTree outputs) in parallel
+    on a process pool.
+
+    PARAMS
+    ------
+    tree_paths: iterable of str; paths to the tree files.
+    workers: int; number of worker processes. None (default) uses one per CPU, 1 loads serially.
+    chunksize: int; number of files sent to a worker at a time.
+    kwargs: passed on to loadNexus().
+
+    RETURNS
+    -------
+    trees: list of baltic tree objects, in the same order as `tree_paths`.
+    """
+    jobs=[(tree_path,kwargs) for tree_path in tree_paths]
+    return _run_pool(_loadNexus_worker,jobs,workers,chunksize)
+
+
+_NPZ_FLOATS=['length','height','absoluteTime','x','y','childHeight']
+
+def _to_json(value):
+    """ Trait values (and tree-level attributes) in a form json can write back exactly: tuples are tagged so they come back as tuples. """
+    if isinstance(value,dict):
+        if not all(isinstance(key,str) for key in value):
+            raise TypeError('Only string keys can be stored: %s'%(list(value.keys())))
+        return {key:_to_json(v) for key,v in value.items()}
+    if isinstance(value,tuple):
+        return {'__tuple__':[_to_json(v) for v in value]}
+    if isinstance(value,list):
+        return [_to_json(v) for v in value]
+    if value is None or isinstance(value,(str,bool,int,float)):
+        return value
+    raise TypeError('Cannot store values of type %s'%(type(value).__name__))
+
+def _from_json(obj):
+    """ json object_hook undoing _to_json(). """
+    if len(obj)==1 and '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    return obj
+
+
+def save_tree_npz(ll, path):
+    """Writes a baltic tree to a compact columnar binary (.npz) file: topology, branch lengths,
+    heights, absolute times, layout coordinates, names and traits. Read it back with load_tree_npz().
+
+    PARAMS
+    ------
+    ll: baltic tree object.
+    path: str; output file path.
+
+    Raises TypeError if a trait holds something other than strings, numbers, booleans, None, and lists, tuples
+    or string-keyed dicts of those.
+    """
+    flat=ll.toFlat()
+    columns={'branchType':np.array([1 if b=='node' else 0 for b in flat['branchType']],dtype=np.uint8),
+             'parent':np.array(flat['parent'],dtype=np.int32),
+             'index':np.array([-1]+flat['index'][1:],dtype=np.int64), ## root index is always 'Root'
+             'objects':np.array(flat['objects'],dtype=np.int32)}
+    for col in _NPZ_FLOATS:
+        columns[col]=np.array([np.nan if v is None else v for v in flat[col]],dtype=np.float64)
+    for col in ['name','numName']:
+        columns[col]=np.array(['' if v is None else v for v in flat[col]],dtype=str)
+        columns[col+'_set']=np.array([v is not None for v in flat[col]],dtype=bool)
+    ## traits are heterogeneous, keep them (and the tree-level attributes) as JSON text, so reading never unpickles anything
+    columns['traits']=np.frombuffer(json.dumps(_to_json(flat['traits'])).encode(),dtype=np.uint8)
+    meta={'tipMap':flat['tipMap'],'treeHeight':flat['treeHeight'],'ySpan':flat['ySpan'],'compact':flat['compact']}
+    columns['meta']=np.frombuffer(json.dumps(_to_json(meta)).encode(),dtype=np.uint8)
+
+    tmp_path='%s.%d.tmp'%(path,os.getpid())
+    with open(tmp_path,'wb') as handle:
+        np.savez(handle,**columns)
+    os.replace(tmp_path,path) ## never leave a half-written file behind
+
+
+def load_tree_npz(path):
+    """Reads a baltic tree written by save_tree_npz(). Traits are stored as JSON and nothing is unpickled,
+    so reading a file does not run code from it.
+
+    PARAMS
+    ------
+    path: str; path to the .npz file.
+
+    RETURNS
+    -------
+    ll: baltic tree object.
+    """
+    with np.load(path,allow_pickle=False) as columns:
+        n=len(columns['parent'])
+        flat={'branchType':['node' if b==1 else 'leaf' for b in columns['branchType'].tolist()],
+              'parent':columns['parent'].tolist(),
+              'index':['Root']+columns['index'][1:].tolist(),
+              'objects':columns['objects'].tolist()}
+        for col in _NPZ_FLOATS:
+            values=columns[col]
+            missing=np.isnan(values).tolist()
+            flat[col]=[None if m else v for m,v in zip(missing,values.tolist())]
+        for col in ['name','numName']:
+            flat[col]=[v if s else None for v,s in zip(columns[col].tolist(),columns[col+'_set'].tolist())]
+        flat['traits']=json.loads(columns['traits'].tobytes().decode(),object_hook=_from_json)
+        flat.update(json.loads(columns['meta'].tobytes().decode(),object_hook=_from_json))
+    assert len(flat['traits'])==n,'Corrupt tree file: %s'%(path)
+    return bt.tree_from_flat(flat)
+
+
+def _cache_key(loader, tree_path, kwargs):
+    """Content hash of the tree file combined with the loader and its arguments."""
+    digest=hashlib.sha1()
+    with open(tree_path,'rb') as handle:
+        for chunk in iter(lambda: handle.read(2**20),b''):
+            digest.update(chunk)
+    digest.update(repr((loader.__name__,sorted(kwargs.items()))).encode())
+    return digest.hexdigest()
+
+
+def _cached_read(loader, tree_path, kwargs, cache_dir, cache_max_bytes):
+    """Returns loader(tree_path, **kwargs), going through the tree cache in `cache_dir`."""
+    os.makedirs(cache_dir,exist_ok=True)
+    path=os.path.join(cache_dir,'%s.npz'%(_cache_key(loader,tree_path,kwargs)))
+    if os.path.exists(path):
+        try:
+            ll=load_tree_npz(path)
+            os.utime(path) ## mark as recently used
+            return ll
+        except Exception as err: ## unreadable entry, rebuild it
+            print('WARNING: discarding unreadable cache entry %s (%s)'%(path,err))
+            os.remove(path)
+
+    ll=loader(tree_path,**kwargs)
+    try:
+        save_tree_npz(ll,path)
+    except TypeError as err: ## traits that can't be written out, the tree is simply not cached
+        print('WARNING: not caching %s (%s)'%(tree_path,err))
+        return ll
+    _evict_cache(cache_dir,cache_max_bytes)
+    return ll
+
+
+def _evict_cache(cache_dir, cache_max_bytes):
+    """Deletes least recently used cache entries until `cache_dir` fits in `cache_max_bytes`."""
+    entries=[]
+    for fn in os.listdir(cache_dir):
+        if fn.endswith('.npz'):
+            st=os.stat(os.path.join(cache_dir,fn))
+            entries.append((st.st_mtime,st.st_size,fn))
+    total=sum(size for _,size,_ in entries)
+    for _,size,fn in sorted(entries):
+        if total<=cache_max_bytes:
+            break
+        os.remove(os.path.join(cache_dir,fn))
+        total-=size
+
+
 def treesub_to_bt(fn_in, fn_out, verbose=True):
     """
     IMPT NOTE: dm output not working. Parse substitutions.tsv output directly instead
@@ -478,8 +994,8 @@ def assign_inode_traits(tree, trait_name):
     If all leaves of that node have the same trait, then that inode will have that trait.
     Otherwise, that node will be assigned 'undef'. Helpful in colouring the branches of monophyletic clades:
     branch colours are inherited from the trait colour assignment of each parent node. 
-    This code is actually pretty inefficient, because the same node.leaves operation is called for _all_
-    inodes. 
+    Each node's leaves are read off the tree's tip order (tree.tipOrder[nd.firstTip:nd.lastTip]), so no per-node
+    lists of tips are needed.
     
     Params
     ------
@@ -492,17 +1008,16 @@ def assign_inode_traits(tree, trait_name):
     tre2: Baltic tree with nodes assigned with traits. 
     """
 
+    tree.refresh(layout=False)
     inodes_ls = tree.nodes
 
     inode_trait = "undef" # init
     for nd in inodes_ls:
-        leaves_ls_temp = nd.leaves # Leaves of the current node
-        lf_traits_ls = []
-        for lf in nd.leaves:
-            lf_traits_ls.append(lf.traits[trait_name])
+        lf_traits_ls = [lf.traits[trait_name] for lf in tree.tipOrder[nd.firstTip:nd.lastTip]] # Leaves of the current node
 
-        if len(np.unique(lf_traits_ls)) == 1:
-            node_trait = np.unique(lf_traits_ls)[0]
+        node_trait = inode_trait
+        if len(set(lf_traits_ls)) == 1:
+            node_trait = lf_traits_ls[0]
         
         # write nd.traits in-place, which I hate.
         nd.traits[trait_name] = node_trait
@@ -510,6 +1025,83 @@ def assign_inode_traits(tree, trait_name):
     return tree
 
 
+def get_clade_labels(tree, ref_names_ls, verbose=True, threshold=None):
+    """Labels every tip of a baltic tree with its nearest reference tip by patristic
+    (tip-to-mrca-to-tip) distance. Baltic counterpart of experimental.get_clade_labels(),
+    returning the same columns without converting to Bio.Phylo.
+
+    Distances come from node heights: for each reference, the path from it to the root
+    splits the tip order into slices of tips sharing the same most recent common
+    ancestor with it, so a whole column of distances takes one walk up the tree
+    (O(n * no. of references) overall).
+
+    PARAMS
+    ------
+    tree: baltic tree object, traversed so that heights are set.
+    ref_names_ls: a list of reference tip names.
+    verbose: verbosity parameter.
+    threshold: float; optional. Tips further than this from their nearest reference
+    are left unlabelled (clade_label is None).
+
+    RETURNS
+    -------
+    df: pandas dataframe with columns: tip_names, their distance to every given
+    reference name, the nearest reference label, and the nearest reference distance.
+    """
+    t0 = time.time()
+    tree.refresh(layout=False)
+
+    tips = tree.tipOrder
+    tip_dict = {k.name: k for k in tips}
+
+    # Check
+    for ref_nm in ref_names_ls:
+        if ref_nm not in tip_dict:
+            print("WARNING: %s not found in input tree!" % ref_nm)
+    ref_names_ls = [nm for nm in ref_names_ls if nm in tip_dict]
+    ref_set = set(ref_names_ls)
+
+    is_query = np.array([k.name not in ref_set for k in tips], dtype=bool)
+    if verbose:
+        print("No. of reference tip names = %s" % len(ref_names_ls))
+        print("No. of non-reference tip names = %s" % is_query.sum())
+
+    # Distance of every tip to every reference
+    height = np.array([k.height for k in tips], dtype=np.float64)
+    dists = np.empty((len(tips), len(ref_names_ls)), dtype=np.float64)
+    mrca_height = np.empty(len(tips), dtype=np.float64)
+    for j, ref_nm in enumerate(ref_names_ls):
+        ref = tip_dict[ref_nm]
+        mrca_height[ref.firstTip] = ref.height
+        first, last = ref.firstTip, ref.firstTip + 1
+        anc = ref.parent
+        while anc is not None:
+            # tips of anc outside the part of the tree already covered have anc as their mrca with ref
+            mrca_height[anc.firstTip:first] = anc.height
+            mrca_height[last:anc.lastTip] = anc.height
+            first, last = anc.firstTip, anc.lastTip
+            anc = anc.parent
+        dists[:, j] = height + ref.height - 2*mrca_height
+
+    col_names = ["tip_name"]
+    for ref_nm in ref_names_ls:
+        col_names.append("dist_to_"+ref_nm)
+
+    df = pd.DataFrame(data=dists[is_query], columns=col_names[1:])
+    df.insert(0, "tip_name", [k.name for k, q in zip(tips, is_query) if q])
+
+    if verbose:
+        print("Done in %.2fs" % (time.time() - t0))
+
+    query_dists = dists[is_query]
+    df["clade_label"] = [ref_names_ls[j] for j in np.argmin(query_dists, axis=1)] if len(ref_names_ls) > 0 else None
+    df["min_dist"] = query_dists.min(axis=1) if len(ref_names_ls) > 0 else np.nan
+    if threshold is not None:
+        df.loc[df["min_dist"] > threshold, "clade_label"] = None
+
+    return df
+
+
 def brew_colour_dictionary(my_list, scheme="qualitative", style="paired"):
     """Create a colour dictionary based on colorbrew presets.
     
@@ -613,6 +1205,64 @@ def decimalDate(date,fmt="%Y-%m-%d",variable=False,dateSplitter='-'):
     return result
 
 
+def decimalDates(dates,fmt="%Y-%m-%d",variable=True,dateSplitter='-'):
+    """ Converts a whole collection of dates to decimal dates in one go, e.g. all tip dates of a tree.
+    Accepts the same inputs as decimalDate(): calendar dates (yyyy-mm-dd, or yyyy-mm/yyyy if `variable`)
+    or values that are already decimal. Repeated dates are converted only once, and calendar dates in the
+    default format are converted with NumPy datetime64 arithmetic rather than one strptime call each.
+
+    Usage:
+    >>> ll.setAbsoluteTime(decimalDates(tip_dates).max())
+
+    PARAMS
+    ------
+    dates: iterable of str or float.
+    fmt, variable, dateSplitter: as in decimalDate(). Non-default formats fall back to decimalDate(), once per distinct date.
+
+    RETURNS
+    -------
+    result: np array of floats, decimal dates in the same order as `dates`.
+    """
+    unique_dates,inverse=np.unique(np.array([str(date) for date in dates],dtype=str),return_inverse=True)
+    converted=np.empty(len(unique_dates),dtype=np.float64)
+
+    calendar=[] ## positions of distinct dates that still need converting from calendar dates
+    for i,date in enumerate(unique_dates.tolist()):
+        if isfloat(date):
+            converted[i]=float(date)
+        else:
+            calendar.append(i)
+
+    if len(calendar)>0 and fmt=="%Y-%m-%d" and dateSplitter=='-':
+        strings=unique_dates[calendar]
+        ## numpy also reads things like 'today', 'NaT' or '2016-08-11T12', only hand it plain yyyy(-mm(-dd)) dates
+        ## (just complete ones unless `variable`) and let decimalDate() deal with, or complain about, the rest
+        pattern=re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}' if variable==False else r'[0-9]{4}(-[0-9]{2}){0,2}')
+        complete=np.array([pattern.fullmatch(date) is not None for date in strings.tolist()],dtype=bool)
+        try:
+            days=strings[complete].astype('datetime64[D]') ## yyyy-mm and yyyy become the first day of the month/year
+        except ValueError: ## something numpy can't read (e.g. unpadded months), convert those one by one below
+            complete[:]=False
+        else:
+            years=days.astype('datetime64[Y]')
+            boy=years.astype('datetime64[D]') ## beginning of the year
+            eoy=(years+1).astype('datetime64[D]') ## beginning of next year
+            idx=np.array(calendar)[complete]
+            converted[idx]=years.astype(np.int64)+1970+(days-boy).astype(np.float64)/(eoy-boy).astype(np.float64)
+            calendar=np.array(calendar)[~complete].tolist()
+
+    for i in calendar:
+        converted[i]=_decimalDate_cached(str(unique_dates[i]),fmt,variable,dateSplitter)
+
+    return converted[inverse.reshape(-1)]
+
+
+@functools.lru_cache(maxsize=None)
+def _decimalDate_cached(date,fmt,variable,dateSplitter):
+    """ Memoized decimalDate(), for dates decimalDates() can't vectorize. """
+    return decimalDate(date,fmt=fmt,variable=variable,dateSplitter=dateSplitter)
+
+
 def isfloat(value):
     """Checks if a string can be converted into a float.
     """
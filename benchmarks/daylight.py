@@ -0,0 +1,43 @@
+"""
+Time taken by one equal-daylight pass of an unrooted layout, tree.drawUnrooted(daylight=1).
+
+Lays out a caterpillar (ladder) tree, the deepest shape a tree of n tips can take, and a
+random bifurcating tree of 2k, 5k and 20k tips each.
+
+Usage:
+    python benchmarks/daylight.py [number of tips ...]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import baltic3 as bt
+from memory import random_tree_string
+
+def caterpillar_string(n,seed=1):
+    """ Tree string where every internal branch has a tip as one of its two children. """
+    rnd=random.Random(seed)
+    parts=['(1:%.5f,2:%.5f)'%(rnd.random(),rnd.random())]
+    for i in range(3,n+1):
+        parts.append(':%.5f,%d:%.5f)'%(rnd.random(),i,rnd.random()))
+    return '('*(n-2)+''.join(parts)+';'
+
+def measure(tree_string):
+    """ Seconds taken by drawUnrooted() with a single equal-daylight pass. """
+    ll=bt.tree()
+    bt.make_tree_fast(tree_string,ll)
+    ll.traverse_tree()
+    ll.sortBranches()
+    start=time.perf_counter()
+    ll.drawUnrooted(daylight=1)
+    return time.perf_counter()-start
+
+if __name__ == '__main__':
+    sizes=[int(n) for n in sys.argv[1:]] or [2000,5000,20000]
+    shapes=[('caterpillar',caterpillar_string),('random',random_tree_string)]
+
+    print('%10s'%('tips')+''.join(['%14s'%(name) for name,_ in shapes]))
+    for n in sizes:
+        print('%10d'%(n)+''.join(['%13.2fs'%(measure(make(n))) for _,make in shapes]))
@@ -0,0 +1,57 @@
+"""
+Memory footprint of parsed trees, reported as bytes per tip.
+
+Builds random BEAST-style trees (two annotations per branch) of 1k, 10k and 100k tips
+and measures, with tracemalloc, what the parsed tree object holds on to in each mode:
+regular and compact (slotted) branch classes, each with and without trait names interned
+through tree.internTraitKeys(). The saving is that of compact over regular branches, both interned.
+
+Usage:
+    python benchmarks/memory.py [number of tips ...]
+"""
+import os
+import sys
+import gc
+import random
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import baltic3 as bt
+
+def random_tree_string(n,seed=1):
+    """ Random bifurcating tree string with n tips and [&rate=...,state="..."] annotations on every branch. """
+    rnd=random.Random(seed)
+    comment=lambda: '[&rate=%.4f,state="%s"]'%(rnd.random(),rnd.choice('ABCD'))
+    items=['%d%s:%.5f'%(i+1,comment(),rnd.random()) for i in range(n)]
+    while len(items)>1:
+        for _ in range(2): ## move two random branches to the end of the list
+            i=rnd.randrange(len(items))
+            items[i],items[-1]=items[-1],items[i]
+        b=items.pop()
+        a=items.pop()
+        items.append('(%s,%s)%s:%.5f'%(a,b,comment(),rnd.random()))
+    return items[0]+';'
+
+def measure(tree_string,compact=False,intern=False):
+    """ Bytes allocated by the tree object once the tree string has been parsed. """
+    gc.collect()
+    tracemalloc.start()
+    ll=bt.tree(compact=compact)
+    bt.make_tree_fast(tree_string,ll)
+    if intern:
+        ll.internTraitKeys()
+    gc.collect()
+    size,_=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(ll.leaves)>0
+    return size
+
+if __name__ == '__main__':
+    sizes=[int(n) for n in sys.argv[1:]] or [1000,10000,100000]
+    modes=[('regular',dict()),('regular+interned',dict(intern=True)),('compact',dict(compact=True)),('compact+interned',dict(compact=True,intern=True))]
+
+    print('%10s'%('tips')+''.join(['%20s'%(name) for name,_ in modes]))
+    for n in sizes:
+        tree_string=random_tree_string(n)
+        per_tip=[measure(tree_string,**kwargs)/float(n) for _,kwargs in modes]
+        print('%10d'%(n)+''.join(['%14.0f B/tip'%(b) for b in per_tip])+'   (%.0f%% saved)'%(100*(1-per_tip[3]/per_tip[1])))
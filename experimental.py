@@ -94,6 +94,8 @@ def tip_to_tip_distance(my_tree, tip1, tip2):
 def genetic_distance_matrix(my_tree, names_ls):
     """Returns an upper triangular similarity matrix of all pairwise branch
     distances between possible pairs of tipnames in names_ls.
+    For baltic trees, tree.distanceMatrix() computes the full (or condensed)
+    matrix natively and much faster.
 
     PARAMS
     ------
@@ -127,7 +129,8 @@ def genetic_distance_matrix(my_tree, names_ls):
 def get_clade_labels(my_tree, ref_names_ls, verbose=True):
     """Computes tip-to-tmrc-to-tip distances for each tipname in my_tree, to
     each reference name in ref_names_ls. my_tree must contain the reference
-    names in ref_names_ls.
+    names in ref_names_ls. For baltic trees, baltic3_utils.get_clade_labels()
+    returns the same columns in a fraction of the time.
 
     PARAMS
     ------
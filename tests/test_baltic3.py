@@ -0,0 +1,55 @@
+import os
+import sys
+import random
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import baltic3 as bt
+
+tree_string='((A[&state="x"]:1.0,B[&state="y"]:2.0)[&posterior=0.9]:0.5,(C:1.5,(D:0.5,E:0.25):0.75):1.0);'
+
+def random_tree_string(n,seed=1):
+    """ Random bifurcating tree string with n tips and a posterior on every node. """
+    rnd=random.Random(seed)
+    items=['%d:%.4f'%(i+1,rnd.random()) for i in range(n)]
+    while len(items)>1:
+        a=items.pop(rnd.randrange(len(items)))
+        b=items.pop(rnd.randrange(len(items)))
+        items.append('(%s,%s)[&posterior=%.3f]:%.4f'%(a,b,rnd.random(),rnd.random()))
+    return items[0]+';'
+
+def make(compact=False):
+    ll=bt.tree(compact=compact)
+    bt.make_tree(tree_string,ll)
+    ll.traverse_tree()
+    return ll
+
+def test_compact_branches_have_no_dict():
+    for k in (bt.compact_node(),bt.compact_leaf(),bt.compact_clade('clade')):
+        assert not hasattr(k,'__dict__')
+
+def test_compact_branches_share_bases_with_regular_ones():
+    ll=make(compact=True)
+    assert all(isinstance(k,bt.leaf_base) for k in ll.leaves) and len(ll.leaves)==5
+    assert all(isinstance(k,bt.node_base) for k in ll.nodes)
+    assert isinstance(bt.leaf(),bt.leaf_base) and isinstance(bt.node(),bt.node_base) and isinstance(bt.clade('clade'),bt.clade_base)
+    assert ll.nodes[0].leaves==make().nodes[0].leaves
+
+def test_round_trips_copy_traits():
+    for compact in (False,True):
+        ll=make(compact=compact)
+        for copied in (bt.tree_from_flat(ll.toFlat()),ll.toArrays().toTree(),ll.toArrays()):
+            for k in copied.Objects:
+                k.traits['state']='edited'
+            assert sorted(k.traits.get('state') for k in ll.leaves if 'state' in k.traits)==['x','y']
+            assert not any(k.traits.get('state')=='edited' for k in ll.Objects)
+
+def test_childHeight_after_collapsing_matches_a_fresh_traversal():
+    for seed in range(5):
+        ll=bt.tree()
+        bt.make_tree(random_tree_string(100,seed),ll)
+        ll.traverse_tree()
+        ll.sortBranches()
+        for collapsed in (ll.collapseBranches('posterior',lambda x:x<=0.5),ll.collapseBranches('posterior',lambda x:x<=0.9)):
+            childHeights=[k.childHeight for k in collapsed.nodes]
+            collapsed.traverse_tree()
+            assert childHeights==[k.childHeight for k in collapsed.nodes]
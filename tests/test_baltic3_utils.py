@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import baltic3 as bt
+import baltic3_utils as btu
+
+def test_decimalDates_matches_decimalDate():
+    dates=['2016-08-11','2016-08','2016','2016-8-1','2016.5','2016-08-11']
+    assert btu.decimalDates(dates).tolist()==[btu.decimalDate(d,variable=True) for d in dates]
+
+@pytest.mark.parametrize('date',['today','NaT','2016-08-11T12'])
+def test_decimalDates_rejects_what_decimalDate_rejects(date):
+    with pytest.raises(ValueError):
+        btu.decimalDate(date,variable=True)
+    with pytest.raises(ValueError):
+        btu.decimalDates(['2016-01-01',date])
+
+@pytest.mark.parametrize('engine',['regex','fast'])
+def test_loadNexus_names_tree_line_without_tree_string(tmp_path,engine):
+    path=tmp_path/'broken.nex'
+    path.write_text('#NEXUS\nbegin trees;\n\ttree TREE1 = [&R] missing;\nend;\n')
+    with pytest.raises(ValueError,match='tree TREE1 = \\[&R\\] missing;'):
+        btu.loadNexus(str(path),engine=engine)
+
+def test_tree_npz_round_trip_without_pickle(tmp_path):
+    ll=bt.tree()
+    bt.make_tree('((A[&state="x",rate=0.5]:1.0,B:2.0)[&posterior=0.9]:0.5,C:1.5);',ll)
+    ll.traverse_tree()
+    ll.leaves[0].traits['codons']=[(12,0.25,'A','G')]
+    ll.nodes[-1].traits['changePoints']=[(0.5,{'state':'y','range':[1.0,2.0]})]
+    path=str(tmp_path/'tree.npz')
+    btu.save_tree_npz(ll,path)
+    with np.load(path,allow_pickle=False) as columns:
+        assert columns['traits'].dtype==np.uint8
+    copied=btu.load_tree_npz(path)
+    assert [k.traits for k in copied.Objects]==[k.traits for k in ll.Objects]
+    assert copied.leaves[0].traits['codons'][0]==(12,0.25,'A','G')
+
+def test_save_tree_npz_refuses_traits_it_cannot_write(tmp_path):
+    ll=bt.tree()
+    bt.make_tree('(A:1.0,B:2.0);',ll)
+    ll.leaves[0].traits['object']=object()
+    with pytest.raises(TypeError):
+        btu.save_tree_npz(ll,str(tmp_path/'tree.npz'))